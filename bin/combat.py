@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+import argparse, sys, os, errno
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
+
+def read_batch_info(filename, batch_index=1, sample_ids=None):
+    """Read batch labels from a batch info file
+
+    Parameters
+    ----------
+    filename: str
+        Tab-separated file with sample IDs in the first column and batch variables in other columns
+    batch_index: int
+        1-based index of the batch variable (not counting the sample ID column)
+    sample_ids: list of str
+        Return batch labels of these samples in the same order
+
+    Returns
+    -------
+    batch: ndarray of str
+    """
+    import pandas as pd
+
+    batch_info = pd.read_table(filename, sep='\t', index_col=0, dtype='str')
+    batch = batch_info.iloc[:, batch_index - 1]
+    if sample_ids is not None:
+        missing = pd.Index(sample_ids).difference(batch.index)
+        if len(missing) > 0:
+            raise ValueError('samples not found in batch info: {}'.format(', '.join(missing[:5])))
+        batch = batch.loc[sample_ids]
+    return batch.values
+
+class ComBat(object):
+    """Batch effect correction with parametric empirical Bayes (ComBat in the sva package)
+
+    The design (batch labels of samples) is built once and can be applied to multiple matrices
+    with the same samples. No covariates are included (mod = ~1).
+
+    Parameters
+    ----------
+    batch: array-like, shape (n_samples,)
+        Batch labels of samples
+    """
+    def __init__(self, batch):
+        import numpy as np
+
+        self.batch_names, self.batch_codes = np.unique(np.asarray(batch, dtype='str'), return_inverse=True)
+        self.n_batches = self.batch_names.shape[0]
+        self.n_samples = self.batch_codes.shape[0]
+        self.batch_sizes = np.bincount(self.batch_codes, minlength=self.n_batches)
+        if np.any(self.batch_sizes < 2):
+            raise ValueError('each batch should contain at least 2 samples')
+        # one-hot design matrix, shape (n_samples, n_batches)
+        self.design = np.zeros((self.n_samples, self.n_batches))
+        self.design[np.arange(self.n_samples), self.batch_codes] = 1
+        # averaging operator within batches: solve(crossprod(design), t(design))
+        self.batch_mean_operator = self.design/self.batch_sizes
+
+    def _batch_means(self, X):
+        # shape (n_features, n_batches)
+        return X @ self.batch_mean_operator
+
+    def _batch_vars(self, X):
+        """Sample variances (ddof=1) of each feature within batches, shape (n_features, n_batches)
+        """
+        means = self._batch_means(X)
+        sum2 = ((X - means[:, self.batch_codes])**2) @ self.design
+        return sum2/(self.batch_sizes - 1)
+
+    def transform(self, X, conv=1e-4, max_iter=1000):
+        """Correct batch effects
+
+        Parameters
+        ----------
+        X: ndarray, shape (n_features, n_samples)
+            Expression matrix (usually log-transformed)
+        conv: float
+            Convergence threshold of relative changes in the empirical Bayes iteration
+
+        Returns
+        -------
+        X_corrected: ndarray, shape (n_features, n_samples)
+            Features that are constant within any batch are left unchanged
+        """
+        import numpy as np
+
+        X = np.asarray(X, dtype=np.float64)
+        if X.shape[1] != self.n_samples:
+            raise ValueError('expect {} samples but the matrix has {} columns'.format(self.n_samples, X.shape[1]))
+        keep = np.all(self._batch_vars(X) > 0, axis=1)
+        result = X.copy()
+        if not np.any(keep):
+            logging.getLogger('combat').warning('no feature has non-zero variance in all batches. '
+                'The matrix is not corrected')
+            return result
+        X = X[keep]
+        # standardize data
+        batch_means = self._batch_means(X)
+        grand_mean = batch_means @ (self.batch_sizes/float(self.n_samples))
+        var_pooled = np.mean((X - batch_means[:, self.batch_codes])**2, axis=1)
+        std_pooled = np.sqrt(var_pooled)[:, np.newaxis]
+        s_data = (X - grand_mean[:, np.newaxis])/std_pooled
+        # batch effect parameters, shape (n_features, n_batches)
+        gamma_hat = self._batch_means(s_data)
+        delta_hat = self._batch_vars(s_data)
+        # priors of each batch, shape (n_batches,)
+        gamma_bar = np.mean(gamma_hat, axis=0)
+        t2 = np.var(gamma_hat, axis=0, ddof=1)
+        m = np.mean(delta_hat, axis=0)
+        s2 = np.var(delta_hat, axis=0, ddof=1)
+        a_prior = (2*s2 + m**2)/s2
+        b_prior = (m*s2 + m**3)/s2
+        gamma_star, delta_star = self._fit_eb(s_data, gamma_hat, delta_hat, gamma_bar, t2,
+            a_prior, b_prior, conv=conv, max_iter=max_iter)
+        # adjust data
+        s_data = (s_data - gamma_star[:, self.batch_codes])/np.sqrt(delta_star[:, self.batch_codes])
+        result[keep] = s_data*std_pooled + grand_mean[:, np.newaxis]
+        return result
+
+    def _fit_eb(self, s_data, gamma_hat, delta_hat, gamma_bar, t2, a_prior, b_prior, conv=1e-4, max_iter=1000):
+        """Empirical Bayes estimates of all batches and features (it.sol in sva)
+
+        All batches are updated together. A batch stops updating once it has converged
+        so that the results are the same as solving batches one by one.
+        """
+        import numpy as np
+
+        n = self.batch_sizes.astype(np.float64)
+        g_old, d_old = gamma_hat.copy(), delta_hat.copy()
+        if g_old.shape[0] == 0:
+            return g_old, d_old
+        active = np.ones(self.n_batches, dtype=bool)
+        for i in range(max_iter):
+            b = np.nonzero(active)[0]
+            g_new = (t2[b]*n[b]*gamma_hat[:, b] + d_old[:, b]*gamma_bar[b])/(t2[b]*n[b] + d_old[:, b])
+            # sum of squares of each feature within batches
+            g_all = g_old.copy()
+            g_all[:, b] = g_new
+            sum2 = (((s_data - g_all[:, self.batch_codes])**2) @ self.design)[:, b]
+            d_new = (0.5*sum2 + b_prior[b])/(n[b]/2.0 + a_prior[b] - 1.0)
+            change = np.maximum(np.max(np.abs(g_new - g_old[:, b])/g_old[:, b], axis=0),
+                np.max(np.abs(d_new - d_old[:, b])/d_old[:, b], axis=0))
+            g_old[:, b] = g_new
+            d_old[:, b] = d_new
+            active[b[change <= conv]] = False
+            if not np.any(active):
+                break
+        else:
+            logging.getLogger('combat').warning('empirical Bayes estimates did not converge after {} iterations'.format(max_iter))
+        return g_old, d_old
+
+def combat(args):
+    from ioutils import read_matrix, write_matrix
+    import numpy as np
+    import pandas as pd
+
+    model = None
+    for input_file in args.input_file:
+        logger.info('read matrix: ' + input_file)
+        matrix = read_matrix(input_file)
+        if model is None:
+            logger.info('read batch info: ' + args.batch_info)
+            batch = read_batch_info(args.batch_info, args.batch_index, matrix.columns.values)
+            model = ComBat(batch)
+            sample_ids = matrix.columns.values
+            logger.info('{} batches: {}'.format(model.n_batches, ', '.join(model.batch_names)))
+        elif not np.array_equal(matrix.columns.values, sample_ids):
+            # the design is reused for matrices with the same samples
+            matrix = matrix.loc[:, sample_ids]
+        X = matrix.values
+        if args.log:
+            X = np.log(X + args.pseudo_count)
+        X = model.transform(X)
+        if args.log:
+            X = np.exp(X)
+        output_file = args.output_file.replace('{name}', os.path.splitext(os.path.basename(input_file))[0])
+        logger.info('write matrix: ' + output_file)
+        write_matrix(output_file, pd.DataFrame(X, index=matrix.index, columns=matrix.columns))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch effect correction with ComBat')
+    parser.add_argument('--input-file', '-i', type=str, action='append', required=True,
+        help='input matrix (rows are features and columns are samples). '
+        'Can be specified multiple times to correct matrices of the same samples')
+    parser.add_argument('--batch-info', '-b', type=str, required=True,
+        help='batch info file (sample IDs in the first column)')
+    parser.add_argument('--batch-index', type=int, default=1,
+        help='1-based index of the batch variable column (not counting the sample ID column)')
+    parser.add_argument('--log', action='store_true',
+        help='correct log(x + pseudo_count) and transform back with exp (as in matrix-process.R)')
+    parser.add_argument('--pseudo-count', type=float, default=0.001,
+        help='pseudo count added before log transformation')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='output file name. "{name}" is replaced by the input file name without extension '
+        '(required for multiple input files)')
+
+    args = parser.parse_args()
+    logger = logging.getLogger('combat')
+    if (len(args.input_file) > 1) and ('{name}' not in args.output_file):
+        raise ValueError('output file name should contain "{name}" when multiple input files are given')
+    combat(args)
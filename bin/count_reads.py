@@ -8,18 +8,22 @@ def command_handler(f):
     command_handlers[f.__name__] = f
     return f
 
-@command_handler
-def count_transcript(args):
-    import pysam
-    import numpy as np
-    from ioutils import open_file_or_stdout
+def count_bam_by_reference(filename, min_mapping_quality=0, strandness='no', threads=1):
+    """Count reads mapped to each reference sequence in a BAM/SAM file
+
+    Returns
+    -------
+    references: tuple of str or None
+        Reference names in the header
+    counts: OrderedDict
+        Number of reads for each reference name with at least one read
+    """
     from collections import OrderedDict
+    from ioutils import open_alignment_file
 
-    logger.info('read input BAM/SAM file: ' + args.input_file)
-    sam = pysam.AlignmentFile(args.input_file, "rb")
+    sam = open_alignment_file(filename, "rb", threads=threads)
     counts = OrderedDict()
-    min_mapping_quality = args.min_mapping_quality
-    strandness = {'no': 0, 'forward': 1, 'reverse': 2}.get(args.strandness, 0)
+    strandness = {'no': 0, 'forward': 1, 'reverse': 2}.get(strandness, 0)
     for read in sam:
         if read.is_unmapped:
             continue
@@ -32,15 +36,349 @@ def count_transcript(args):
         if read.reference_name not in counts:
             counts[read.reference_name] = 0
         counts[read.reference_name] += 1
+    references = None
+    if sam.header is not None:
+        references = sam.header.references
+    sam.close()
+    return references, counts
+
+def count_bam_by_reference_id(filename, min_mapping_quality=0, strandness='no', batch_size=1000000, threads=1):
+    """Count reads mapped to each reference sequence in a BAM/SAM file using integer reference ids
+
+    Reference ids, mapping qualities and flags are buffered for a batch of reads.
+    Filters are applied to the whole batch and counts are accumulated into 
+    a numpy array indexed by reference id.
+
+    Returns
+    -------
+    references: tuple of str
+        Reference names in the header
+    counts: ndarray, shape (n_references,)
+        Number of reads for each reference in the header
+    """
+    import numpy as np
+    from array import array
+    from ioutils import open_alignment_file
+
+    sam = open_alignment_file(filename, "rb", threads=threads)
+    references = sam.references
+    n_references = len(references)
+    counts = np.zeros(n_references, dtype=np.int64)
+    strandness = {'no': 0, 'forward': 1, 'reverse': 2}.get(strandness, 0)
+
+    def add_batch(reference_ids, mapping_qualities, flags):
+        reference_ids = np.frombuffer(reference_ids, dtype=np.int32)
+        mapping_qualities = np.frombuffer(mapping_qualities, dtype=np.uint8)
+        flags = np.frombuffer(flags, dtype=np.uint16)
+        # 0x4: unmapped, 0x10: reverse strand
+        keep = ((flags & 0x4) == 0) & (reference_ids >= 0) & (mapping_qualities >= min_mapping_quality)
+        if strandness == 1:
+            keep &= (flags & 0x10) == 0
+        elif strandness == 2:
+            keep &= (flags & 0x10) != 0
+        counts[:] += np.bincount(reference_ids[keep], minlength=n_references)
+
+    reference_ids = array('i')
+    mapping_qualities = array('B')
+    flags = array('H')
+    for read in sam:
+        reference_ids.append(read.reference_id)
+        mapping_qualities.append(read.mapping_quality)
+        flags.append(read.flag)
+        if len(reference_ids) >= batch_size:
+            add_batch(reference_ids, mapping_qualities, flags)
+            reference_ids = array('i')
+            mapping_qualities = array('B')
+            flags = array('H')
+    if len(reference_ids) > 0:
+        add_batch(reference_ids, mapping_qualities, flags)
+    sam.close()
+    return references, counts
+
+def _count_shard_worker(task):
+    import numpy as np
+    from ioutils import open_alignment_file
+
+    filename, reference_ids, min_mapping_quality, strandness = task
+    strandness = {'no': 0, 'forward': 1, 'reverse': 2}.get(strandness, 0)
+    sam = open_alignment_file(filename, "rb")
+    counts = np.zeros(len(reference_ids), dtype=np.int64)
+    for i, reference_id in enumerate(reference_ids):
+        n = 0
+        for read in sam.fetch(sam.get_reference_name(reference_id)):
+            if read.is_unmapped:
+                continue
+            if read.mapping_quality < min_mapping_quality:
+                continue
+            if (strandness == 1) and read.is_reverse:
+                continue
+            if (strandness == 2) and (not read.is_reverse):
+                continue
+            n += 1
+        counts[i] = n
+    sam.close()
+    return reference_ids, counts
+
+def count_bam_sharded(filename, min_mapping_quality=0, strandness='no', jobs=1):
+    """Count reads mapped to each reference sequence in an indexed BAM file in parallel
+
+    References are split into shards with similar number of mapped reads 
+    (according to the BAM index) and each shard is counted in a separate process.
+
+    Returns
+    -------
+    references: tuple of str
+        Reference names in the header
+    counts: ndarray, shape (n_references,)
+        Number of reads for each reference in the header
+    """
+    import numpy as np
+    from multiprocessing import Pool
+    from ioutils import open_alignment_file
+
+    sam = open_alignment_file(filename, "rb")
+    references = sam.references
+    mapped = np.zeros(len(references), dtype=np.int64)
+    for stat in sam.get_index_statistics():
+        mapped[sam.get_tid(stat.contig)] = stat.mapped
+    sam.close()
+    # assign references with most reads first to the shard with fewest reads
+    n_shards = min(jobs*4, len(references))
+    shards = [[] for i in range(n_shards)]
+    shard_sizes = np.zeros(n_shards, dtype=np.int64)
+    for reference_id in np.argsort(-mapped, kind='mergesort'):
+        if mapped[reference_id] == 0:
+            continue
+        i = np.argmin(shard_sizes)
+        shards[i].append(int(reference_id))
+        shard_sizes[i] += mapped[reference_id]
+    tasks = [(filename, shard, min_mapping_quality, strandness) for shard in shards if len(shard) > 0]
+
+    counts = np.zeros(len(references), dtype=np.int64)
+    pool = Pool(processes=jobs)
+    for reference_ids, shard_counts in pool.imap_unordered(_count_shard_worker, tasks):
+        counts[reference_ids] = shard_counts
+    pool.close()
+    pool.join()
+    return references, counts
+
+@command_handler
+def count_transcript(args):
+    from ioutils import open_file_or_stdout, bam_has_index, read_bam_index_counts
+
+    logger.info('read input BAM/SAM file: ' + args.input_file)
+    references = None
+    has_index = bam_has_index(args.input_file)
+    if (args.min_mapping_quality <= 0) and (args.strandness == 'no') and has_index:
+        logger.info('no filters applied. Get read counts from BAM index statistics')
+        references, counts = read_bam_index_counts(args.input_file)
+    elif args.jobs > 1:
+        if has_index:
+            logger.info('count reads in parallel using {} processes'.format(args.jobs))
+            references, counts = count_bam_sharded(args.input_file,
+                min_mapping_quality=args.min_mapping_quality,
+                strandness=args.strandness, jobs=args.jobs)
+        else:
+            logger.warning('input file is not an indexed BAM file. Count reads serially')
+    if (references is None) and args.by_reference_id:
+        logger.info('count reads by reference id')
+        references, counts = count_bam_by_reference_id(args.input_file,
+            min_mapping_quality=args.min_mapping_quality,
+            strandness=args.strandness, threads=args.threads)
+    if references is not None:
+        with open_file_or_stdout(args.output_file) as f:
+            for name, count in zip(references, counts):
+                f.write('{}\t{}\n'.format(name, count))
+        return
+
+    logger.info('count reads by reference name')
+    references, counts = count_bam_by_reference(args.input_file,
+        min_mapping_quality=args.min_mapping_quality,
+        strandness=args.strandness, threads=args.threads)
     
     with open_file_or_stdout(args.output_file) as f:
-        if sam.header is not None:
-            for name in sam.header.references:
+        if references is not None:
+            for name in references:
                 f.write('{}\t{}\n'.format(name, counts.get(name, 0)))
         else:
             for name, count in counts.items():
                 f.write('{}\t{}\n'.format(name, count))
 
+def _count_bam_worker(task):
+    filename, min_mapping_quality, strandness, by_reference_id, threads = task
+    if by_reference_id:
+        import numpy as np
+
+        references, counts = count_bam_by_reference_id(filename,
+            min_mapping_quality=min_mapping_quality, strandness=strandness, threads=threads)
+        nonzero = np.nonzero(counts)[0]
+        return [references[i] for i in nonzero], counts[nonzero].tolist()
+    references, counts = count_bam_by_reference(filename,
+        min_mapping_quality=min_mapping_quality, strandness=strandness, threads=threads)
+    return list(counts.keys()), list(counts.values())
+
+def read_sample_inputs(input_files=None, sample_sheet=None, strip_extension=True):
+    """Get input files of samples from file names and a sample sheet
+
+    Parameters
+    ----------
+    strip_extension: bool
+        Remove the file extension from sample IDs of input_files.
+        Set to False for files named by sample IDs that may contain '.'.
+
+    Returns
+    -------
+    inputs: list of tuple
+        (sample_id, filename). Sample ID of input_files is the file name (without extension).
+    sample_ids: list of str
+        Unique sample IDs in the order of first appearance
+    """
+    inputs = []
+    if sample_sheet is not None:
+        logger.info('read sample sheet: ' + sample_sheet)
+        with open(sample_sheet, 'r') as f:
+            for line in f:
+                c = line.strip().split('\t')
+                if (len(c) < 2) or c[0].startswith('#'):
+                    continue
+                inputs.append((c[0], c[1]))
+    if input_files is not None:
+        # multiple files of a sample are only allowed in a sample sheet
+        input_file_names = {}
+        for filename in input_files:
+            sample_id = os.path.basename(filename)
+            if strip_extension:
+                sample_id = os.path.splitext(sample_id)[0]
+            if sample_id in input_file_names and input_file_names[sample_id] != filename:
+                raise ValueError('input files {} and {} have the same sample ID {}. '
+                    'Use --sample-sheet to specify sample IDs'.format(input_file_names[sample_id], filename, sample_id))
+            input_file_names[sample_id] = filename
+            inputs.append((sample_id, filename))
+    if len(inputs) == 0:
+        raise ValueError('no input files given by --input-file or --sample-sheet')
+    sample_ids = []
+    for sample_id, filename in inputs:
+        if sample_id not in sample_ids:
+            sample_ids.append(sample_id)
+    return inputs, sample_ids
+
+class CountMatrixBuilder(object):
+    """Build a sparse count matrix (rows are features and columns are samples) from per-sample counts
+
+    Feature names are mapped to row indices at once when the matrix is built.
+    Counts of the same feature and sample are summed.
+    """
+    def __init__(self, sample_ids):
+        self.sample_ids = list(sample_ids)
+        self.sample_index = {sample_id:i for i, sample_id in enumerate(self.sample_ids)}
+        self.feature_names = []
+        self.values = []
+        self.col_ind = []
+
+    def add(self, sample_id, feature_names, counts):
+        import numpy as np
+
+        self.feature_names.append(np.asarray(feature_names, dtype='str'))
+        self.values.append(np.asarray(counts, dtype=np.int32))
+        self.col_ind.append(np.full(len(feature_names), self.sample_index[sample_id], dtype=np.int32))
+
+    def build(self):
+        """
+        Returns
+        -------
+        matrix: scipy.sparse.csr_matrix, shape (n_features, n_samples)
+        feature_ids: ndarray
+            Sorted feature names
+        """
+        import numpy as np
+        from scipy import sparse
+
+        if len(self.feature_names) == 0:
+            return sparse.csr_matrix((0, len(self.sample_ids)), dtype=np.int32), np.zeros(0, dtype='str')
+        feature_ids, row_ind = np.unique(np.concatenate(self.feature_names), return_inverse=True)
+        matrix = sparse.coo_matrix((np.concatenate(self.values), (row_ind, np.concatenate(self.col_ind))),
+            shape=(len(feature_ids), len(self.sample_ids))).tocsr()
+        return matrix, feature_ids
+
+def annotate_features(feature_ids, transcript_tables, feature_type='transcript_id'):
+    """Rename features to gene_id|gene_type|gene_name using transcript tables
+    """
+    import pandas as pd
+
+    transcript_table = []
+    for filename in transcript_tables:
+        logger.info('read transcript table: ' + filename)
+        transcript_table.append(pd.read_table(filename, sep='\t', dtype='str'))
+    transcript_table = pd.concat(transcript_table, axis=0)
+    transcript_table = transcript_table.drop_duplicates(feature_type, keep='first')
+    transcript_table.set_index(feature_type, inplace=True, drop=False)
+    transcript_table = transcript_table.loc[feature_ids]
+    return (transcript_table['gene_id'] + '|' + transcript_table['gene_type'] \
+        + '|' + transcript_table['gene_name']).values
+
+def write_count_matrix(filename, matrix, feature_names, sample_ids, format='table'):
+    """Write a sparse count matrix as dense tab-separated text or sparse npz
+    """
+    import pandas as pd
+    from ioutils import prepare_output_file, write_sparse_matrix, write_matrix
+
+    logger.info('count matrix: {} features, {} samples, {} non-zero entries'.format(
+        matrix.shape[0], matrix.shape[1], matrix.nnz))
+    logger.info('create output file: ' + filename)
+    prepare_output_file(filename)
+    if format == 'table':
+        matrix = pd.DataFrame(matrix.toarray(), index=feature_names, columns=sample_ids)
+        matrix.index.name = 'feature'
+        write_matrix(filename, matrix, format='table')
+    elif format == 'npz':
+        write_sparse_matrix(filename, matrix, row_names=feature_names, col_names=sample_ids)
+    else:
+        raise ValueError('unknown output format: {}'.format(format))
+
+@command_handler
+def count_matrix(args):
+    from multiprocessing import Pool
+
+    inputs, sample_ids = read_sample_inputs(args.input_file, args.sample_sheet)
+    logger.info('count reads in {} BAM files from {} samples using {} processes'.format(
+        len(inputs), len(sample_ids), args.jobs))
+
+    tasks = [(filename, args.min_mapping_quality, args.strandness, args.by_reference_id, args.threads)
+        for sample_id, filename in inputs]
+    builder = CountMatrixBuilder(sample_ids)
+    pool = Pool(processes=args.jobs)
+    for i, (names, counts) in enumerate(pool.imap(_count_bam_worker, tasks)):
+        logger.info('counted {} features in {}'.format(len(names), inputs[i][1]))
+        builder.add(inputs[i][0], names, counts)
+    pool.close()
+    pool.join()
+    matrix, feature_ids = builder.build()
+
+    feature_names = feature_ids
+    if args.transcript_table:
+        feature_names = annotate_features(feature_ids, args.transcript_table, args.feature_type)
+    write_count_matrix(args.output_file, matrix, feature_names, sample_ids, format=args.output_format)
+
+@command_handler
+def merge_count_matrix(args):
+    import pandas as pd
+
+    # count files are named by sample IDs without extensions
+    inputs, sample_ids = read_sample_inputs(args.input_file, args.sample_sheet, strip_extension=False)
+    logger.info('read {} count files from {} samples'.format(len(inputs), len(sample_ids)))
+    builder = CountMatrixBuilder(sample_ids)
+    for sample_id, filename in inputs:
+        counts = pd.read_table(filename, sep='\t', header=None, comment='#',
+            names=['feature', 'count'], dtype={'feature': 'str', 'count': 'int'})
+        counts = counts[counts['count'] > 0]
+        builder.add(sample_id, counts['feature'].values, counts['count'].values)
+    matrix, feature_ids = builder.build()
+
+    feature_names = feature_ids
+    if args.transcript_table:
+        feature_names = annotate_features(feature_ids, args.transcript_table, args.feature_type)
+    write_count_matrix(args.output_file, matrix, feature_names, sample_ids, format=args.output_format)
+
 if __name__ == '__main__':
     main_parser = argparse.ArgumentParser(description='Count reads in BAM files')
     subparsers = main_parser.add_subparsers(dest='command')
@@ -53,8 +391,60 @@ if __name__ == '__main__':
     parser.add_argument('--strandness', '-s', type=str, default='no',
         choices=('forward', 'reverse', 'no'),
         help='forward/reverse: only count reads in reverse strand. no: count reads in both strands')
+    parser.add_argument('--by-reference-id', action='store_true',
+        help='count reads by integer reference ids in batches (faster for large BAM files with a header)')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression (per process)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to count reads in parallel (requires a coordinate-sorted and indexed BAM file)')
     parser.add_argument('--output-file', '-o', type=str, default='-',
         help='output file')
+
+    parser = subparsers.add_parser('count_matrix',
+        help='count reads in multiple BAM files and create a count matrix (rows are features and columns are samples)')
+    parser.add_argument('--input-file', '-i', type=str, action='append',
+        help='input BAM/SAM file. Sample ID is the file name without extension. Can be specified multiple times')
+    parser.add_argument('--sample-sheet', type=str,
+        help='tab-separated file with 2 columns: sample_id, path of BAM/SAM file. A sample can have multiple BAM/SAM files')
+    parser.add_argument('--min-mapping-quality', '-q', type=int, default=0,
+        help='only count reads with mapping quality greater than this number')
+    parser.add_argument('--strandness', '-s', type=str, default='no',
+        choices=('forward', 'reverse', 'no'),
+        help='forward/reverse: only count reads in reverse strand. no: count reads in both strands')
+    parser.add_argument('--by-reference-id', action='store_true',
+        help='count reads by integer reference ids in batches (faster for large BAM files with a header)')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression (per process)')
+    parser.add_argument('--transcript-table', type=str, action='append',
+        help='transcript table used to rename features to gene_id|gene_type|gene_name. Can be specified multiple times')
+    parser.add_argument('--feature-type', type=str, default='transcript_id',
+        choices=('transcript_id', 'gene_id'),
+        help='column in the transcript table that matches reference names in BAM files')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of BAM files to count in parallel')
+    parser.add_argument('--output-format', type=str, default='table',
+        choices=('table', 'npz'),
+        help='table: dense tab-separated text. npz: sparse matrix in numpy npz format')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='output count matrix file')
+    
+    parser = subparsers.add_parser('merge_count_matrix',
+        help='merge per-sample count files into a count matrix (rows are features and columns are samples)')
+    parser.add_argument('--input-file', '-i', type=str, action='append',
+        help='input count file with 2 columns: feature, count. '
+        'Sample ID is the file name. Can be specified multiple times')
+    parser.add_argument('--sample-sheet', type=str,
+        help='tab-separated file with 2 columns: sample_id, path of count file. A sample can have multiple count files')
+    parser.add_argument('--transcript-table', type=str, action='append',
+        help='transcript table used to rename features to gene_id|gene_type|gene_name. Can be specified multiple times')
+    parser.add_argument('--feature-type', type=str, default='transcript_id',
+        choices=('transcript_id', 'gene_id'),
+        help='column in the transcript table that matches feature names in count files')
+    parser.add_argument('--output-format', type=str, default='table',
+        choices=('table', 'npz'),
+        help='table: dense tab-separated text. npz: sparse matrix in numpy npz format')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='output count matrix file')
     
     args = main_parser.parse_args()
     if args.command is None:
@@ -287,7 +287,9 @@ class FeatureSelection(object):
     
     @define_step(inputs=['matrix_file'], outputs=['X', 'sample_classes'])
     def read_data(self):
-        self.X = pd.read_table(self.matrix_file, index_col=0)
+        from ioutils import read_matrix
+
+        self.X = read_matrix(self.matrix_file)
         if self.transpose:
             self.logger.info('transpose feature matrix')
             self.X = self.X.T
@@ -8,32 +8,108 @@ def command_handler(f):
     command_handlers[f.__name__] = f
     return f
 
-@command_handler
-def preprocess_features(args):
+def get_feature_info(feature_names):
+    """Split feature names (gene_id|gene_type|gene_name|feature_id|transcript_id|start|end) into a table
+    """
+    import pandas as pd
+
+    feature_info = pd.Series(feature_names, index=feature_names).str.split('|', expand=True)
+    feature_info.columns = ['gene_id', 'gene_type', 'gene_name', 'feature_id', 'transcript_id', 'start', 'end']
+    feature_info['start'] = feature_info['start'].astype('int')
+    feature_info['end'] = feature_info['end'].astype('int')
+    feature_info['length'] = feature_info['end'] - feature_info['start']
+    return feature_info
+
+def take_submatrix(X, rows, columns=None):
+    """Gather selected rows (and columns) of a matrix into memory
+
+    Only the selected elements are read if X is memory-mapped.
+
+    Parameters
+    ----------
+    X: ndarray or numpy.memmap, shape (n_rows, n_columns)
+    rows: array of int
+        Row indices
+    columns: array of int
+        Column indices. All columns are selected if None.
+
+    Returns
+    -------
+    submatrix: ndarray, shape (len(rows), len(columns))
+    """
+    import numpy as np
+
+    if columns is None:
+        return np.asarray(X[rows])
+    return np.asarray(X[np.ix_(rows, columns)])
+
+def select_sparse_features(args):
+    """Read a sparse matrix and apply feature filters of preprocess_features before densifying
+
+    Returns
+    -------
+    X: pandas.DataFrame
+        Dense matrix of selected features (rows are samples and columns are features)
+    """
     import numpy as np
     import pandas as pd
-    from sklearn.preprocessing import StandardScaler, RobustScaler, MinMaxScaler, MaxAbsScaler
+    from ioutils import read_sparse_matrix
 
-    logger.info('read feature matrix: ' + args.matrix)
-    X = pd.read_table(args.matrix, index_col=0, sep='\t')
+    logger.info('read sparse feature matrix: ' + args.matrix)
+    X, sample_ids, feature_names = read_sparse_matrix(args.matrix)
     if args.transpose:
         logger.info('transpose feature matrix')
-        X = X.T
+        X, sample_ids, feature_names = X.T, feature_names, sample_ids
+    X = X.tocsc()
+    X.eliminate_zeros()
+    n_samples = X.shape[0]
     logger.info('{} samples, {} features'.format(X.shape[0], X.shape[1]))
     if args.remove_zero_features is not None:
         logger.info('remove features with zero fraction larger than {}'.format(args.remove_zero_features))
-        X = X.loc[:, ~(np.isclose(X, 0).sum(axis=0) > (X.shape[0]*args.remove_zero_features))]
+        n_zeros = n_samples - X.getnnz(axis=0)
+        selected = np.nonzero(~(n_zeros > (n_samples*args.remove_zero_features)))[0]
+        X, feature_names = X[:, selected], feature_names[selected]
     if args.rpkm_top is not None:
         logger.info('select top {} features ranked by RPKM'.format(args.rpkm_top))
-        feature_info = X.columns.to_series().str.split('|', expand=True)
-        feature_info.columns = ['gene_id', 'gene_type', 'gene_name', 'feature_id', 'transcript_id', 'start', 'end']
-        feature_info['start'] = feature_info['start'].astype('int')
-        feature_info['end'] = feature_info['end'].astype('int')
-        feature_info['length'] = feature_info['end'] - feature_info['start']
-        rpkm = 1e3*X.div(feature_info['length'], axis=1)
-        mean_rpkm = np.exp(np.log(rpkm + 0.01).mean(axis=0)) - 0.01
-        features_select = mean_rpkm.sort_values(ascending=False)[:args.rpkm_top].index.values
-        X = X.loc[:, features_select]
+        feature_info = get_feature_info(feature_names)
+        rpkm = X.multiply(1e3/feature_info['length'].values.reshape((1, -1))).tocsc()
+        # mean of log(rpkm + 0.01) over all samples. Zero entries contribute log(0.01)
+        log_rpkm = rpkm.copy()
+        log_rpkm.data = np.log(log_rpkm.data + 0.01)
+        mean_log_rpkm = (np.asarray(log_rpkm.sum(axis=0)).ravel() \
+            + (n_samples - rpkm.getnnz(axis=0))*np.log(0.01))/n_samples
+        mean_rpkm = pd.Series(np.exp(mean_log_rpkm) - 0.01, index=np.arange(X.shape[1]))
+        selected = mean_rpkm.sort_values(ascending=False)[:args.rpkm_top].index.values
+        X, feature_names = X[:, selected], feature_names[selected]
+    logger.info('convert {} features to a dense matrix'.format(X.shape[1]))
+    return pd.DataFrame(X.toarray(), index=sample_ids, columns=feature_names)
+
+@command_handler
+def preprocess_features(args):
+    import numpy as np
+    import pandas as pd
+    from sklearn.preprocessing import StandardScaler, RobustScaler, MinMaxScaler, MaxAbsScaler
+    from ioutils import read_matrix, write_matrix, is_sparse_matrix
+
+    if is_sparse_matrix(args.matrix):
+        X = select_sparse_features(args)
+    else:
+        logger.info('read feature matrix: ' + args.matrix)
+        X = read_matrix(args.matrix)
+        if args.transpose:
+            logger.info('transpose feature matrix')
+            X = X.T
+        logger.info('{} samples, {} features'.format(X.shape[0], X.shape[1]))
+        if args.remove_zero_features is not None:
+            logger.info('remove features with zero fraction larger than {}'.format(args.remove_zero_features))
+            X = X.loc[:, ~(np.isclose(X, 0).sum(axis=0) > (X.shape[0]*args.remove_zero_features))]
+        if args.rpkm_top is not None:
+            logger.info('select top {} features ranked by RPKM'.format(args.rpkm_top))
+            feature_info = get_feature_info(X.columns)
+            rpkm = 1e3*X.div(feature_info['length'], axis=1)
+            mean_rpkm = np.exp(np.log(rpkm + 0.01).mean(axis=0)) - 0.01
+            features_select = mean_rpkm.sort_values(ascending=False)[:args.rpkm_top].index.values
+            X = X.loc[:, features_select]
     feature_names = X.columns.values
     logger.info('{} samples, {} features'.format(X.shape[0], X.shape[1]))
     logger.info('sample: {} ...'.format(str(X.index.values[:3])))
@@ -61,7 +137,7 @@ def preprocess_features(args):
     
     X = pd.DataFrame(X, index=sample_ids, columns=feature_names)
     X.index.name = 'sample'
-    X.to_csv(args.output_file, sep='\t', header=True, index=True, na_rep='NA')
+    write_matrix(args.output_file, X, format=args.output_format)
 
 @command_handler
 def evaluate(args):
@@ -79,20 +155,21 @@ def evaluate(args):
         RepeatedKFold, RepeatedStratifiedKFold, LeaveOneOut, StratifiedShuffleSplit
     import pickle
     from estimators import RobustEstimator
+    from ioutils import read_matrix_values
     from tqdm import tqdm
     import h5py
 
     logger.info('read feature matrix: ' + args.matrix)
-    m = pd.read_table(args.matrix, index_col=0, sep='\t')
-    feature_names = m.columns.values
-    logger.info('{} samples, {} features'.format(m.shape[0], m.shape[1]))
-    logger.info('sample: {} ...'.format(str(m.index.values[:3])))
-    logger.info('features: {} ...'.format(str(m.columns.values[:3])))
+    # values of a dense npz matrix are memory-mapped and only gathered when needed
+    X, sample_names, feature_names = read_matrix_values(args.matrix, mmap_mode='r')
+    logger.info('{} samples, {} features'.format(X.shape[0], X.shape[1]))
+    logger.info('sample: {} ...'.format(str(sample_names[:3])))
+    logger.info('features: {} ...'.format(str(feature_names[:3])))
 
     logger.info('read sample classes: ' + args.sample_classes)
     sample_classes = pd.read_table(args.sample_classes, index_col=0, sep='\t')
     sample_classes = sample_classes.iloc[:, 0]
-    sample_classes = sample_classes.loc[m.index.values]
+    sample_classes = sample_classes.loc[sample_names]
     logger.info('sample_classes: {}'.format(sample_classes.shape[0]))
 
     # select samples
@@ -108,34 +185,33 @@ def evaluate(args):
     negative_class = np.atleast_1d(negative_class)
 
     logger.info('positive class: {}, negative class: {}'.format(positive_class, negative_class))
-    X_pos = m.loc[sample_classes[sample_classes.isin(positive_class)].index.values]
-    X_neg = m.loc[sample_classes[sample_classes.isin(negative_class)].index.values]
+    # rows of selected samples in the matrix: positive samples followed by negative samples
+    pos_index = np.nonzero(sample_classes.isin(positive_class).values)[0]
+    neg_index = np.nonzero(sample_classes.isin(negative_class).values)[0]
     logger.info('number of positive samples: {}, negative samples: {}, class ratio: {}'.format(
-        X_pos.shape[0], X_neg.shape[0], float(X_pos.shape[0])/X_neg.shape[0]))
-    X = pd.concat([X_pos, X_neg], axis=0)
-    y = np.zeros(X.shape[0], dtype=np.int32)
-    y[X_pos.shape[0]:] = 1
-    del X_pos
-    del X_neg
-    n_samples, n_features = X.shape
-    sample_ids = X.index.values
+        pos_index.shape[0], neg_index.shape[0], float(pos_index.shape[0])/neg_index.shape[0]))
+    sample_index = np.concatenate([pos_index, neg_index])
+    y = np.zeros(sample_index.shape[0], dtype=np.int32)
+    y[pos_index.shape[0]:] = 1
+    n_samples = sample_index.shape[0]
+    n_features = X.shape[1]
+    sample_ids = sample_names[sample_index]
 
     if not os.path.isdir(args.output_dir):
         logger.info('create outout directory: ' + args.output_dir)
         os.makedirs(args.output_dir)
 
     logger.info('save sample ids')
-    X.index.to_series().to_csv(os.path.join(args.output_dir, 'samples.txt'),
+    pd.Series(sample_ids).to_csv(os.path.join(args.output_dir, 'samples.txt'),
         sep='\t', header=False, index=False)
     logger.info('save sample classes')
     np.savetxt(os.path.join(args.output_dir, 'classes.txt'), y, fmt='%d')
 
-    # get numpy array from DataFrame
-    X = X.values
-
     # check NaN values
-    if np.any(np.isnan(X)):
-        logger.info('nan values found in features')
+    for start in range(0, n_samples, 1024):
+        if np.any(np.isnan(take_submatrix(X, sample_index[start:(start + 1024)]))):
+            logger.info('nan values found in features')
+            break
     estimator = None
     grid_search = None
     logger.info('use {} to select features'.format(args.method))
@@ -195,12 +271,12 @@ def evaluate(args):
 
     splitter = get_splitter(args.splitter, n_splits=args.n_splits, n_repeats=args.n_repeats)
     metrics = []
-    predictions = np.full((splitter.get_n_splits(X), X.shape[0]), np.nan)
-    predicted_labels = np.full((splitter.get_n_splits(X), X.shape[0]), np.nan)
-    train_index_matrix = np.zeros((splitter.get_n_splits(X), X.shape[0]),dtype=np.bool)
+    predictions = np.full((splitter.get_n_splits(sample_index), n_samples), np.nan)
+    predicted_labels = np.full((splitter.get_n_splits(sample_index), n_samples), np.nan)
+    train_index_matrix = np.zeros((splitter.get_n_splits(sample_index), n_samples),dtype=bool)
     feature_selection_matrix = None
     if args.n_select is not None:
-        feature_selection_matrix = np.zeros((splitter.get_n_splits(X), X.shape[1]), dtype=bool)
+        feature_selection_matrix = np.zeros((splitter.get_n_splits(sample_index), n_features), dtype=bool)
     if args.rfe:
         if 0.0 < args.rfe_step < 1.0:
             rfe_step = int(max(1, args.rfe_step*n_features))
@@ -209,15 +285,16 @@ def evaluate(args):
         rfe_scores = None
     i_split = 0
     scorer = get_scorer(args.scorer)
-    data_splits = list(splitter.split(X, y))
+    data_splits = list(splitter.split(sample_index, y))
     data_splits.append((np.arange(n_samples), None))
-    for train_index, test_index in tqdm(data_splits, total=splitter.get_n_splits(X) + 1, unit='fold'):
-        X_train, y_train = X[train_index], y[train_index]
-        X_test, y_test = X[test_index], y[test_index]
+    for train_index, test_index in tqdm(data_splits, total=splitter.get_n_splits(sample_index) + 1, unit='fold'):
+        # gather rows of the training samples for this fold
+        X_train, y_train = take_submatrix(X, sample_index[train_index]), y[train_index]
+        y_test = y[test_index] if test_index is not None else None
         # optimize hyper-parameters
         if grid_search is not None:
             cv = GridSearchCV(estimator, grid_search, cv=5)
-            cv.fit(X[train_index], y[train_index])
+            cv.fit(X_train, y_train)
             estimator = cv.best_estimator_
         
         sample_weight = np.ones(X_train.shape[0])
@@ -242,39 +319,41 @@ def evaluate(args):
             # RFE feature selection
             elif args.rfe:
                 rfe = RFE(estimator, n_features_to_select=args.n_select, step=rfe_step)
-                if i_split < splitter.get_n_splits(X):
+                if i_split < splitter.get_n_splits(sample_index):
                     if args.splitter == 'leave_one_out':
                         # AUC is undefined for only one test sample
                         step_score = lambda estimator, features: np.nan
                     else:
                         step_score = lambda estimator, features: scorer(y_test, 
-                            score_function(estimator)(X[test_index][:, features])[:, 1])
+                            score_function(estimator)(take_submatrix(X, sample_index[test_index], features))[:, 1])
                 else:
                     step_score = None
                 rfe._fit(X_train, y_train, step_score=step_score)
                 features = np.nonzero(rfe.ranking_ == 1)[0]
-                if i_split < splitter.get_n_splits(X):
+                if i_split < splitter.get_n_splits(sample_index):
                     if rfe_scores is None:
                         rfe_n_steps = len(rfe.scores_)
                         rfe_n_features_step = np.maximum(n_features - rfe_step*np.arange(rfe_n_steps), 1)
-                        rfe_scores = np.zeros((splitter.get_n_splits(X), rfe_n_steps))
+                        rfe_scores = np.zeros((splitter.get_n_splits(sample_index), rfe_n_steps))
                     rfe_scores[i_split] = rfe.scores_
                 estimator = rfe.estimator_
             # no feature selection
             else:
                 # train the model
-                estimator.fit(X[train_index], y[train_index], sample_weight=sample_weight)
+                estimator.fit(X_train, y_train, sample_weight=sample_weight)
                 features = np.argsort(-feature_importances(estimator))[:args.n_select]
-            if i_split < splitter.get_n_splits(X):
+            if i_split < splitter.get_n_splits(sample_index):
                 feature_selection_matrix[i_split, features] = True
         else:
             # no feature selection
             features = np.arange(n_features, dtype=np.int64)
         
-        estimator.fit(X[train_index][:, features], y[train_index], sample_weight=sample_weight)
-        if i_split != splitter.get_n_splits(X):
-            predictions[i_split] = score_function(estimator)(X[:, features])[:, 1]
-            predicted_labels[i_split] = estimator.predict(X[:, features])
+        estimator.fit(X_train[:, features], y_train, sample_weight=sample_weight)
+        if i_split != splitter.get_n_splits(sample_index):
+            # only gather the selected features of all samples
+            X_features = take_submatrix(X, sample_index, features)
+            predictions[i_split] = score_function(estimator)(X_features)[:, 1]
+            predicted_labels[i_split] = estimator.predict(X_features)
             metric = {}
             metric['train_{}'.format(args.scorer)] = scorer(y_train, predictions[i_split, train_index])
             # AUC is undefined for only one test sample
@@ -325,7 +404,8 @@ if __name__ == '__main__':
 
     parser = subparsers.add_parser('preprocess_features')
     parser.add_argument('--matrix', '-i', type=str, required=True,
-        help='input feature matrix (rows are samples and columns are features')
+        help='input feature matrix (rows are samples and columns are features). '
+        'Tab-separated or npz format (detected automatically)')
     parser.add_argument('--use-log', action='store_true',
         help='apply log2 to feature matrix')
     parser.add_argument('--transpose', action='store_true', default=False,
@@ -335,6 +415,8 @@ if __name__ == '__main__':
         help='method for scaling features')
     parser.add_argument('--output-file', '-o', type=str, required=True,
         help='output file name')
+    parser.add_argument('--output-format', type=str, choices=('table', 'npz'),
+        help='output matrix format (default: npz if the output file name ends with .npz, otherwise table)')
     parser.add_argument('--remove-zero-features', type=float, 
         help='remove features that have fraction of zero values above this value')
     parser.add_argument('--rpkm-top', type=int,
@@ -342,7 +424,8 @@ if __name__ == '__main__':
     
     parser = subparsers.add_parser('evaluate')
     parser.add_argument('--matrix', '-i', type=str, required=True,
-        help='input feature matrix (rows are samples and columns are features')
+        help='input feature matrix (rows are samples and columns are features). '
+        'Tab-separated or npz format (detected automatically)')
     parser.add_argument('--sample-classes', type=str, required=True,
         help='input file containing sample classes with 2 columns: sample_id, sample_class')
     parser.add_argument('--positive-class', type=str,
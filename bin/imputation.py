@@ -0,0 +1,263 @@
+#! /usr/bin/env python
+import argparse, sys, os, errno
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
+
+def log_transform(X):
+    """Log transformation of counts used for imputation (same as scImpute)
+    """
+    import numpy as np
+
+    return np.log10(X + 1.01)
+
+def _gram_worker(X):
+    L = log_transform(X)
+    return L.T @ L
+
+def _impute_worker(task):
+    X, neighbors, valid, dropout_threshold = task
+    return impute_chunk(X, neighbors, valid, dropout_threshold)
+
+def _map_chunks(worker, tasks, jobs=1):
+    """Apply a module-level worker function to tasks in order, in parallel if jobs > 1
+    """
+    from multiprocessing import Pool
+
+    if jobs <= 1:
+        for task in tasks:
+            yield worker(task)
+        return
+    pool = Pool(processes=jobs)
+    try:
+        for result in pool.imap(worker, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def sample_gram_matrix(X, chunk_size, jobs=1):
+    """Gram matrix of samples on log-transformed counts, accumulated over chunks of features
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+
+    Returns
+    -------
+    gram: ndarray, shape (n_samples, n_samples)
+    """
+    import numpy as np
+
+    n_samples = X.shape[1]
+    gram = np.zeros((n_samples, n_samples))
+    tasks = (X[start:(start + chunk_size)] for start in range(0, X.shape[0], chunk_size))
+    for partial_gram in _map_chunks(_gram_worker, tasks, jobs):
+        gram += partial_gram
+    return gram
+
+def principal_components(gram, n_components=20):
+    """Coordinates of samples on principal components computed from the Gram matrix of samples
+
+    Features are centered by their means across samples, which is equivalent to
+    double centering of the Gram matrix (classical multidimensional scaling).
+    """
+    import numpy as np
+
+    n_samples = gram.shape[0]
+    J = np.eye(n_samples) - 1.0/n_samples
+    centered = J @ gram @ J
+    eigvals, eigvecs = np.linalg.eigh(centered)
+    order = np.argsort(-eigvals)[:min(n_components, n_samples)]
+    eigvals = np.maximum(eigvals[order], 0)
+    return eigvecs[:, order]*np.sqrt(eigvals)
+
+def kmeans(X, n_clusters, n_init=10, max_iter=300, random_state=0):
+    """K-means clustering with k-means++ initialization
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_samples, n_dims)
+
+    Returns
+    -------
+    labels: ndarray of int, shape (n_samples,)
+    """
+    import numpy as np
+
+    rng = np.random.RandomState(random_state)
+    n_samples = X.shape[0]
+    n_clusters = min(n_clusters, n_samples)
+    best_labels, best_inertia = None, np.inf
+    for i_init in range(n_init):
+        # k-means++ seeding
+        centers = [X[rng.randint(n_samples)]]
+        for k in range(1, n_clusters):
+            d2 = np.min(((X[:, np.newaxis, :] - np.array(centers)[np.newaxis, :, :])**2).sum(axis=2), axis=1)
+            if d2.sum() <= 0:
+                centers.append(X[rng.randint(n_samples)])
+            else:
+                centers.append(X[rng.choice(n_samples, p=d2/d2.sum())])
+        centers = np.array(centers)
+        labels = None
+        for i_iter in range(max_iter):
+            d2 = ((X[:, np.newaxis, :] - centers[np.newaxis, :, :])**2).sum(axis=2)
+            new_labels = np.argmin(d2, axis=1)
+            if (labels is not None) and np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            for k in range(n_clusters):
+                if np.any(labels == k):
+                    centers[k] = X[labels == k].mean(axis=0)
+        inertia = np.sum((X - centers[labels])**2)
+        if inertia < best_inertia:
+            best_labels, best_inertia = labels, inertia
+    return best_labels
+
+def find_neighbors(distances, labels, n_neighbors=10):
+    """Nearest neighbors of each sample within its cluster
+
+    Returns
+    -------
+    neighbors: ndarray of int, shape (n_samples, n_neighbors)
+        Indices of neighbors. Padded with 0 for small clusters.
+    valid: ndarray of bool, shape (n_samples, n_neighbors)
+        True for actual neighbors
+    """
+    import numpy as np
+
+    n_samples = distances.shape[0]
+    distances = distances.copy()
+    # exclude samples in other clusters and the sample itself
+    distances[labels[:, np.newaxis] != labels[np.newaxis, :]] = np.inf
+    np.fill_diagonal(distances, np.inf)
+    n_neighbors = min(n_neighbors, max(n_samples - 1, 1))
+    neighbors = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+    valid = np.isfinite(np.take_along_axis(distances, neighbors, axis=1))
+    neighbors[~valid] = 0
+    return neighbors, valid
+
+def impute_chunk(X, neighbors, valid, dropout_threshold=0.5):
+    """Impute zero counts in a chunk of features from neighbors of samples
+
+    A zero count is considered as a dropout if the feature is detected in at least a fraction
+    dropout_threshold of neighbors, and is replaced by the mean log expression of those neighbors.
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Counts of a chunk of features
+    neighbors, valid: ndarray, shape (n_samples, n_neighbors)
+        Returned by find_neighbors
+
+    Returns
+    -------
+    X_imputed: ndarray, shape (n_features, n_samples)
+    """
+    import numpy as np
+
+    X_imputed = X.astype(np.float64)
+    L = log_transform(X_imputed)
+    # values of neighbors, shape (n_features, n_samples, n_neighbors)
+    detected = (X[:, neighbors] > 0) & valid[np.newaxis, :, :]
+    n_valid = np.sum(valid, axis=1)
+    n_detected = np.sum(detected, axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = n_detected/n_valid[np.newaxis, :]
+        mean_log = np.sum(np.where(detected, L[:, neighbors], 0), axis=2)/n_detected
+    dropout = (X == 0) & (n_detected > 0) & (fraction >= dropout_threshold)
+    X_imputed[dropout] = np.maximum(10**mean_log[dropout] - 1.01, 0)
+    return X_imputed
+
+def knn_impute(X, n_clusters=5, n_neighbors=10, dropout_threshold=0.5, n_components=20,
+        jobs=1, max_memory=1024, random_state=0):
+    """Impute dropouts from nearest neighbors of samples within clusters
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+    n_clusters: int
+        Number of sample clusters
+    n_neighbors: int
+        Number of nearest neighbors of each sample used for imputation
+    dropout_threshold: float
+        Minimum fraction of neighbors with non-zero counts for a zero count to be imputed
+    n_components: int
+        Number of principal components used for clustering
+    jobs: int
+        Number of processes
+    max_memory: float
+        Memory budget (in MB) for chunks of features processed at the same time
+
+    Returns
+    -------
+    X_imputed: ndarray, shape (n_features, n_samples)
+    labels: ndarray, shape (n_samples,)
+        Cluster labels of samples
+    """
+    import numpy as np
+
+    logger = logging.getLogger('imputation')
+    n_features, n_samples = X.shape
+    budget = max_memory*1024*1024/max(jobs, 1)
+    # pairwise distances of samples from the Gram matrix of log counts
+    chunk_size = max(1, int(budget//(8*2*n_samples)))
+    gram = sample_gram_matrix(X, chunk_size, jobs=jobs)
+    sq_norms = np.diag(gram)
+    distances = np.sqrt(np.maximum(sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2*gram, 0))
+    # cluster samples on principal components
+    pcs = principal_components(gram, n_components=n_components)
+    labels = kmeans(pcs, n_clusters, random_state=random_state)
+    logger.info('cluster sizes: {}'.format(', '.join(str(size) for size in np.bincount(labels))))
+    neighbors, valid = find_neighbors(distances, labels, n_neighbors)
+    # impute chunks of features in parallel, within the memory budget of gathered neighbor values
+    chunk_size = max(1, int(budget//(8*4*n_samples*max(neighbors.shape[1], 1))))
+    logger.info('impute {} features in chunks of {}'.format(n_features, chunk_size))
+    tasks = ((X[start:(start + chunk_size)], neighbors, valid, dropout_threshold)
+        for start in range(0, n_features, chunk_size))
+    X_imputed = np.empty(X.shape, dtype=np.float64)
+    start = 0
+    for chunk in _map_chunks(_impute_worker, tasks, jobs):
+        X_imputed[start:(start + chunk.shape[0])] = chunk
+        start += chunk.shape[0]
+    return X_imputed, labels
+
+def impute(args):
+    from ioutils import read_matrix, write_matrix
+    import numpy as np
+    import pandas as pd
+
+    logger.info('read count matrix: ' + args.input_file)
+    matrix = read_matrix(args.input_file)
+    logger.info('{} features, {} samples'.format(*matrix.shape))
+    X_imputed, labels = knn_impute(matrix.values, n_clusters=args.n_clusters,
+        n_neighbors=args.n_neighbors, dropout_threshold=args.dropout_threshold,
+        n_components=args.n_components, jobs=args.jobs, max_memory=args.max_memory)
+    logger.info('{} zero counts imputed'.format(np.sum((matrix.values == 0) & (X_imputed > 0))))
+    logger.info('write imputed matrix: ' + args.output_file)
+    write_matrix(args.output_file, pd.DataFrame(X_imputed, index=matrix.index, columns=matrix.columns))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Impute dropouts from nearest neighbors within sample clusters')
+    parser.add_argument('--input-file', '-i', type=str, required=True,
+        help='input count matrix (rows are features and columns are samples). '
+        'Tab-separated or npz format (detected automatically)')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='imputed matrix file')
+    parser.add_argument('--n-clusters', '-k', type=int, default=5,
+        help='number of sample clusters')
+    parser.add_argument('--n-neighbors', type=int, default=10,
+        help='number of nearest neighbors within the cluster used for imputation')
+    parser.add_argument('--dropout-threshold', type=float, default=0.5,
+        help='minimum fraction of neighbors with non-zero counts to impute a zero count')
+    parser.add_argument('--n-components', type=int, default=20,
+        help='number of principal components used for clustering')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes')
+    parser.add_argument('--max-memory', type=float, default=1024,
+        help='memory budget (in MB) of chunks of features processed at the same time')
+
+    args = parser.parse_args()
+    logger = logging.getLogger('imputation')
+    impute(args)
@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+from __future__ import print_function
+import argparse, sys, os, errno
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
+
+command_handlers = {}
+def command_handler(f):
+    command_handlers[f.__name__] = f
+    return f
+
+ANNOTATION_COLUMNS = ['transcript_id', 'gene_id', 'gene_name', 'gene_type', 'transcript_type']
+
+class IntervalIndex(object):
+    """Index of genomic intervals for batched overlap queries
+
+    Intervals are sorted by chromosome and start position. For each chromosome,
+    the running maximum of end positions and the maximum interval length are used
+    to find the first interval that may overlap a query by binary search.
+
+    Parameters
+    ----------
+    chroms: array of str, shape (n_intervals,)
+        Chromosome names
+    starts: array of int, shape (n_intervals,)
+        0-based start positions
+    ends: array of int, shape (n_intervals,)
+        End positions (exclusive)
+    strands: array of str, shape (n_intervals,)
+        '+', '-' or '.'
+    annotations: dict
+        Arrays of attributes for each interval (e.g. transcript_id, gene_id)
+    """
+    def __init__(self, chroms, starts, ends, strands, annotations=None):
+        import numpy as np
+
+        chroms = np.asarray(chroms, dtype='str')
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        strands = np.asarray(strands, dtype='str')
+        if annotations is None:
+            annotations = {}
+        self.chrom_names, chrom_codes = np.unique(chroms, return_inverse=True)
+        order = np.lexsort((starts, chrom_codes))
+        chrom_codes = chrom_codes[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.strands = np.select([strands[order] == '+', strands[order] == '-'], [1, -1], 0).astype(np.int8)
+        self.annotations = {key: np.asarray(values, dtype='str')[order] for key, values in annotations.items()}
+        self._build(chrom_codes)
+
+    def _build(self, chrom_codes):
+        import numpy as np
+
+        n_chroms = len(self.chrom_names)
+        # intervals on chromosome i are in [chrom_offsets[i], chrom_offsets[i + 1])
+        self.chrom_offsets = np.zeros(n_chroms + 1, dtype=np.int64)
+        self.chrom_offsets[1:] = np.cumsum(np.bincount(chrom_codes, minlength=n_chroms))
+        self.max_ends = np.empty_like(self.ends)
+        self.max_lengths = np.zeros(n_chroms, dtype=np.int64)
+        for i in range(n_chroms):
+            a, b = self.chrom_offsets[i], self.chrom_offsets[i + 1]
+            if b > a:
+                self.max_ends[a:b] = np.maximum.accumulate(self.ends[a:b])
+                self.max_lengths[i] = np.max(self.ends[a:b] - self.starts[a:b])
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    @classmethod
+    def from_transcript_table(cls, filenames, level='transcript'):
+        """Build an index from transcript tables created by gtf_to_transcript_table
+
+        Parameters
+        ----------
+        filenames: list of str
+            Transcript tables. Duplicated transcripts are removed (the first one is kept).
+        level: str
+            'transcript': one interval for each transcript.
+            'gene': one interval for each gene spanning all its transcripts.
+        """
+        import pandas as pd
+
+        table = pd.concat([pd.read_table(filename, sep='\t', dtype='str') for filename in filenames], axis=0)
+        table.drop_duplicates('transcript_id', keep='first', inplace=True)
+        table['start'] = table['start'].astype('int64')
+        table['end'] = table['end'].astype('int64')
+        if level == 'gene':
+            grouped = table.groupby('gene_id', sort=False)
+            table = grouped.first()
+            table['start'] = grouped['start'].min()
+            table['end'] = grouped['end'].max()
+            table['gene_id'] = table.index.values
+            table['transcript_id'] = table.index.values
+        elif level != 'transcript':
+            raise ValueError('unknown level: {}'.format(level))
+        annotations = {key: table[key].fillna('').values for key in ANNOTATION_COLUMNS if key in table.columns}
+        return cls(table['chrom'].values, table['start'].values, table['end'].values,
+            table['strand'].values, annotations)
+
+    def save(self, filename):
+        """Save the index in numpy npz format
+        """
+        import numpy as np
+
+        arrays = {'chrom_names': self.chrom_names, 'chrom_offsets': self.chrom_offsets,
+            'starts': self.starts, 'ends': self.ends, 'strands': self.strands,
+            'max_ends': self.max_ends, 'max_lengths': self.max_lengths,
+            'annotation_keys': np.asarray(list(self.annotations.keys()), dtype='str')}
+        for key, values in self.annotations.items():
+            arrays['annotation.' + key] = values
+        # pass a file object to prevent numpy from appending .npz to the file name
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved by save()
+        """
+        import numpy as np
+
+        index = cls.__new__(cls)
+        with np.load(filename) as f:
+            for key in ('chrom_names', 'chrom_offsets', 'starts', 'ends', 'strands', 'max_ends', 'max_lengths'):
+                setattr(index, key, f[key])
+            index.annotations = {key: f['annotation.' + key] for key in f['annotation_keys']}
+        return index
+
+    def query(self, chroms, starts, ends, strands=None, max_candidates=4194304):
+        """Find intervals that overlap query intervals
+
+        Parameters
+        ----------
+        chroms: array of str, shape (n_queries,)
+            Chromosome names of queries
+        starts: array of int, shape (n_queries,)
+            0-based start positions of queries
+        ends: array of int, shape (n_queries,)
+            End positions (exclusive) of queries
+        strands: array of str, shape (n_queries,)
+            If given, only report intervals on the same strand ('+' or '-') as the queries
+        max_candidates: int
+            Maximum number of candidate pairs of queries and intervals that are checked at the same time.
+            A long interval widens the candidate ranges of all following queries on the chromosome,
+            so candidates are expanded in batches to limit memory usage.
+
+        Returns
+        -------
+        query_indices: ndarray, shape (n_overlaps,)
+            Index of the query of each overlap (sorted)
+        interval_indices: ndarray, shape (n_overlaps,)
+            Index of the overlapping interval in the index
+        """
+        import numpy as np
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(self.chrom_names) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        chrom_codes = np.searchsorted(self.chrom_names, np.asarray(chroms, dtype='str'))
+        chrom_codes = np.minimum(chrom_codes, len(self.chrom_names) - 1)
+        found = self.chrom_names[chrom_codes] == np.asarray(chroms, dtype='str')
+        # candidate intervals of each query are in [lo, hi)
+        lo = np.zeros(starts.shape[0], dtype=np.int64)
+        hi = np.zeros(starts.shape[0], dtype=np.int64)
+        for i in np.unique(chrom_codes[found]):
+            q = np.nonzero(found & (chrom_codes == i))[0]
+            a, b = self.chrom_offsets[i], self.chrom_offsets[i + 1]
+            # intervals before lo cannot overlap: max end <= query start or start <= query start - max length
+            lo[q] = a + np.maximum(np.searchsorted(self.max_ends[a:b], starts[q], side='right'),
+                np.searchsorted(self.starts[a:b], starts[q] - self.max_lengths[i], side='right'))
+            hi[q] = a + np.searchsorted(self.starts[a:b], ends[q], side='left')
+        hi = np.maximum(hi, lo)
+        if strands is not None:
+            strands = np.asarray(strands, dtype='str')
+            query_strands = np.select([strands == '+', strands == '-'], [1, -1], 0).astype(np.int8)
+        # expand candidate ranges in batches of at most max_candidates pairs
+        n_candidates = hi - lo
+        cum_candidates = np.cumsum(n_candidates)
+        n_total = int(cum_candidates[-1]) if cum_candidates.shape[0] > 0 else 0
+        query_indices = []
+        interval_indices = []
+        for batch_start in range(0, n_total, max_candidates):
+            # positions of candidate pairs in the concatenated candidate ranges
+            positions = np.arange(batch_start, min(batch_start + max_candidates, n_total), dtype=np.int64)
+            q = np.searchsorted(cum_candidates, positions, side='right')
+            j = positions - (cum_candidates[q] - n_candidates[q]) + lo[q]
+            keep = self.ends[j] > starts[q]
+            if strands is not None:
+                keep &= self.strands[j] == query_strands[q]
+            query_indices.append(q[keep])
+            interval_indices.append(j[keep])
+        if not query_indices:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(query_indices), np.concatenate(interval_indices)
+
+@command_handler
+def build(args):
+    logger.info('read transcript tables: ' + ', '.join(args.input_file))
+    index = IntervalIndex.from_transcript_table(args.input_file, level=args.level)
+    logger.info('number of intervals: {}'.format(len(index)))
+    logger.info('save index: ' + args.output_file)
+    index.save(args.output_file)
+
+@command_handler
+def query(args):
+    import pandas as pd
+    from ioutils import open_file_or_stdin, open_file_or_stdout
+
+    logger.info('load index: ' + args.index_file)
+    index = IntervalIndex.load(args.index_file)
+    logger.info('read BED file: ' + args.input_file)
+    with open_file_or_stdin(args.input_file) as f:
+        bed = pd.read_table(f, sep='\t', header=None, dtype='str', comment='#')
+    strands = None
+    if args.strand:
+        if bed.shape[1] < 6:
+            raise ValueError('strand column is required in the BED file with --strand')
+        strands = bed.iloc[:, 5].values
+    query_indices, interval_indices = index.query(bed.iloc[:, 0].values,
+        bed.iloc[:, 1].astype('int64').values, bed.iloc[:, 2].astype('int64').values, strands)
+    logger.info('number of overlaps: {}'.format(query_indices.shape[0]))
+    result = bed.iloc[query_indices].copy()
+    result.columns = ['query_' + str(i + 1) for i in range(bed.shape[1])]
+    result['start'] = index.starts[interval_indices]
+    result['end'] = index.ends[interval_indices]
+    for key in args.columns.split(','):
+        result[key] = index.annotations[key][interval_indices]
+    logger.info('write output file: ' + args.output_file)
+    with open_file_or_stdout(args.output_file) as f:
+        result.to_csv(f, sep='\t', header=True, index=False)
+
+if __name__ == '__main__':
+    main_parser = argparse.ArgumentParser(description='Genomic interval index')
+    subparsers = main_parser.add_subparsers(dest='command')
+
+    parser = subparsers.add_parser('build',
+        help='build an interval index from transcript tables')
+    parser.add_argument('--input-file', '-i', type=str, action='append', required=True,
+        help='transcript table created by preprocess.py gtf_to_transcript_table. Can be specified multiple times')
+    parser.add_argument('--level', type=str, default='transcript', choices=('transcript', 'gene'),
+        help='build the index of transcripts or genes')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='output index file')
+
+    parser = subparsers.add_parser('query',
+        help='find genes/transcripts that overlap intervals in a BED file')
+    parser.add_argument('--index-file', '-x', type=str, required=True,
+        help='index file created by the build command')
+    parser.add_argument('--input-file', '-i', type=str, default='-',
+        help='input BED file')
+    parser.add_argument('--strand', '-s', action='store_true',
+        help='only report overlaps on the same strand')
+    parser.add_argument('--columns', type=str, default='transcript_id,gene_id,gene_name,gene_type',
+        help='comma-separated list of annotation columns to report')
+    parser.add_argument('--output-file', '-o', type=str, default='-',
+        help='output table of query intervals (query_*) and overlapping intervals')
+
+    args = main_parser.parse_args()
+    if args.command is None:
+        main_parser.print_help()
+        sys.exit(1)
+    logger = logging.getLogger('interval_index.' + args.command)
+
+    command_handlers.get(args.command)(args)
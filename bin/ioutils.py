@@ -39,6 +39,64 @@ def open_file_or_stdin(filename):
     else:
         return open(filename, 'r')
 
+def open_alignment_file(filename, mode='rb', threads=1, **kwargs):
+    """Open a BAM/SAM file with pysam
+
+    Parameters
+    ----------
+    filename: str or file object
+        Input/output BAM/SAM file
+    mode: str
+        File mode passed to pysam.AlignmentFile
+    threads: int
+        Number of threads used by htslib for BGZF compression/decompression
+    kwargs: dict
+        Other arguments passed to pysam.AlignmentFile
+    """
+    import pysam
+
+    return pysam.AlignmentFile(filename, mode, threads=max(threads, 1), **kwargs)
+
+def bam_has_index(filename):
+    """Check if a file is a BAM file with an index (.bai/.csi)
+    """
+    import pysam
+
+    try:
+        with pysam.AlignmentFile(filename, "rb") as sam:
+            return sam.is_bam and sam.has_index()
+    except (ValueError, OSError):
+        return False
+
+def read_bam_index_counts(filename, include_unmapped=False):
+    """Get number of mapped reads for each reference sequence from the index of a BAM file
+
+    Parameters
+    ----------
+    filename: str
+        Indexed BAM file
+    include_unmapped: bool
+        Also count unmapped reads placed on a reference (e.g. unmapped mates)
+
+    Returns
+    -------
+    references: tuple of str
+        Reference names in the header
+    counts: ndarray, shape (n_references,)
+        Number of mapped reads for each reference in the header
+    """
+    import pysam
+    import numpy as np
+
+    with pysam.AlignmentFile(filename, "rb") as sam:
+        references = sam.references
+        counts = np.zeros(len(references), dtype=np.int64)
+        for stat in sam.get_index_statistics():
+            counts[sam.get_tid(stat.contig)] = stat.mapped
+            if include_unmapped:
+                counts[sam.get_tid(stat.contig)] += stat.unmapped
+    return references, counts
+
 import zipfile
 class ArchiveFile(object):
     def __init__(self, filename, mode='r', format='directory', **kwargs):
@@ -83,3 +141,441 @@ class ArchiveFile(object):
             return self.filename
         elif self.format == 'zip':
             return self.f.namelist()
+
+def write_sparse_matrix(filename, matrix, row_names, col_names):
+    """Save a scipy sparse matrix together with row and column names in numpy npz format
+
+    The file contains arrays "data", "indices", "indptr" and "shape" of the CSR matrix,
+    and arrays "row_names" and "col_names"
+    """
+    import numpy as np
+
+    matrix = matrix.tocsr()
+    # pass a file object to prevent numpy from appending .npz to the file name
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, data=matrix.data, indices=matrix.indices,
+            indptr=matrix.indptr, shape=np.asarray(matrix.shape),
+            row_names=np.asarray(row_names, dtype='str'), col_names=np.asarray(col_names, dtype='str'))
+
+def read_sparse_matrix(filename):
+    """Read a sparse matrix saved by write_sparse_matrix
+
+    Returns
+    -------
+    matrix: scipy.sparse.csr_matrix
+    row_names: array of str
+    col_names: array of str
+    """
+    import numpy as np
+    from scipy import sparse
+
+    with np.load(filename) as f:
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return matrix, f['row_names'], f['col_names']
+
+def scan_fasta(fin, keep_ends=0, block_size=4*1024*1024):
+    """Scan a FASTA file in binary blocks without building whole sequences in memory
+
+    Parameters
+    ----------
+    fin: file object
+        FASTA file opened in binary mode
+    keep_ends: int
+        Number of bases to keep from both ends of each sequence
+    block_size: int
+        Number of bytes to read at a time
+
+    Yields
+    ------
+    record: tuple
+        (name, length, offset, line_bases, line_width, head, tail).
+        The first five elements are the same as a samtools faidx index.
+        head and tail are the first and last keep_ends bases (bytes).
+    """
+    # bytes needed to contain keep_ends bases in the worst case (one base per line with CRLF)
+    max_end_bytes = 3*keep_ends + 3
+    record = None
+    position = 0
+    leftover = b''
+
+    def sequence_length(seg):
+        return len(seg) - seg.count(b'\n') - seg.count(b'\r')
+
+    def add_sequence(record, seg):
+        if len(seg) == 0:
+            return
+        if record['line_width'] is None:
+            line = seg[:(seg.find(b'\n') + 1) or len(seg)]
+            record['line_width'] = len(line)
+            record['line_bases'] = len(line.rstrip(b'\r\n'))
+        record['length'] += sequence_length(seg)
+        if keep_ends > 0:
+            if len(record['head']) < keep_ends:
+                head = seg[:max_end_bytes].replace(b'\n', b'').replace(b'\r', b'')
+                record['head'] += head[:(keep_ends - len(record['head']))]
+            tail = seg[-max_end_bytes:].replace(b'\n', b'').replace(b'\r', b'')
+            record['tail'] = (record['tail'] + tail)[-keep_ends:]
+    
+    def finish(record):
+        return (record['name'], record['length'], record['offset'], 
+            record['line_bases'] or 0, record['line_width'] or 0, 
+            bytes(record['head']), record['tail'])
+
+    while True:
+        block = fin.read(block_size)
+        if not block:
+            chunk = leftover
+            leftover = b''
+        else:
+            chunk = leftover + block
+            # process complete lines only
+            i = chunk.rfind(b'\n')
+            if i < 0:
+                leftover = chunk
+                continue
+            leftover = chunk[(i + 1):]
+            chunk = chunk[:(i + 1)]
+        start = 0
+        while start < len(chunk):
+            if chunk.startswith(b'>', start):
+                header_end = chunk.find(b'\n', start)
+                if header_end < 0:
+                    header_end = len(chunk) - 1
+                if record is not None:
+                    yield finish(record)
+                fields = chunk[(start + 1):header_end].decode().split()
+                record = {'name': fields[0] if fields else '', 'length': 0, 
+                    'offset': position + header_end + 1, 'line_bases': None, 'line_width': None,
+                    'head': bytearray(), 'tail': b''}
+                start = header_end + 1
+            else:
+                end = chunk.find(b'\n>', start)
+                end = len(chunk) if end < 0 else (end + 1)
+                if record is not None:
+                    add_sequence(record, chunk[start:end])
+                start = end
+        position += len(chunk)
+        if not block:
+            break
+    if record is not None:
+        yield finish(record)
+
+def read_fasta_index(filename):
+    """Read a FASTA index file (.fai) created by samtools faidx
+
+    Returns
+    -------
+    index: list of tuple
+        (name, length, offset, line_bases, line_width) of each sequence
+    """
+    index = []
+    with open(filename, 'r') as f:
+        for line in f:
+            c = line.strip().split('\t')
+            index.append((c[0], int(c[1]), int(c[2]), int(c[3]), int(c[4])))
+    return index
+
+def get_fasta_index(filename):
+    """Get the index of a FASTA file
+
+    Read the .fai file if it exists and is newer than the FASTA file. 
+    Otherwise build the index by scanning the FASTA file.
+    """
+    index_file = filename + '.fai'
+    if os.path.exists(index_file) and (os.path.getmtime(index_file) >= os.path.getmtime(filename)):
+        return read_fasta_index(index_file)
+    with open(filename, 'rb') as fin:
+        return [record[:5] for record in scan_fasta(fin)]
+
+def read_fasta_region(fin, entry, start, end):
+    """Read a region of a sequence using offsets in a FASTA index
+
+    Parameters
+    ----------
+    fin: file object
+        FASTA file opened in binary mode
+    entry: tuple
+        (name, length, offset, line_bases, line_width) of the sequence in the FASTA index
+    start, end: int
+        0-based half-open interval of the region
+
+    Returns
+    -------
+    seq: bytes
+    """
+    name, length, offset, line_bases, line_width = entry
+    start = max(0, start)
+    end = min(length, end)
+    if end <= start:
+        return b''
+    def byte_offset(pos):
+        return offset + (pos // line_bases)*line_width + (pos % line_bases)
+    fin.seek(byte_offset(start))
+    data = fin.read(byte_offset(end - 1) - byte_offset(start) + 1)
+    return data.replace(b'\n', b'').replace(b'\r', b'')
+
+def detect_matrix_format(filename):
+    """Detect the format of a matrix file from its content
+
+    Returns
+    -------
+    format: str
+        'npz' for numpy npz files (dense matrices written by write_matrix 
+        or sparse matrices written by write_sparse_matrix), 'table' otherwise
+    """
+    if filename == '-':
+        return 'table'
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'PK\x03\x04':
+        return 'npz'
+    return 'table'
+
+def is_sparse_matrix(filename):
+    """Check if a file contains a sparse matrix written by write_sparse_matrix
+    """
+    import numpy as np
+
+    if detect_matrix_format(filename) != 'npz':
+        return False
+    with np.load(filename) as f:
+        return 'indptr' in f
+
+def read_matrix(filename, format=None):
+    """Read a matrix with row and column names as a pandas DataFrame
+
+    Parameters
+    ----------
+    filename: str
+        Input file. '-' for standard input (table format only).
+    format: str
+        'table' (tab-separated text with row names in the first column and column names in the first line),
+        'npz' (written by write_matrix or write_sparse_matrix)
+        or None (detect from the file content)
+
+    Returns
+    -------
+    matrix: pandas.DataFrame
+    """
+    import numpy as np
+    import pandas as pd
+
+    if format is None:
+        format = detect_matrix_format(filename)
+    if format == 'table':
+        with open_file_or_stdin(filename) as f:
+            return pd.read_table(f, sep='\t', index_col=0)
+    elif format == 'npz':
+        with np.load(filename) as f:
+            if 'values' in f:
+                matrix = pd.DataFrame(f['values'], index=f['row_names'], columns=f['col_names'])
+                if f['index_name'].size > 0:
+                    matrix.index.name = str(f['index_name'][0])
+                return matrix
+        matrix, row_names, col_names = read_sparse_matrix(filename)
+        matrix = pd.DataFrame(matrix.toarray(), index=row_names, columns=col_names)
+        matrix.index.name = 'feature'
+        return matrix
+    else:
+        raise ValueError('unknown matrix format: {}'.format(format))
+
+def write_matrix(filename, matrix, format=None):
+    """Write a pandas DataFrame with row and column names
+
+    Parameters
+    ----------
+    filename: str
+        Output file. '-' for standard output (table format only).
+    matrix: pandas.DataFrame
+        Matrix to write
+    format: str
+        'table' (tab-separated text), 'npz' (uncompressed numpy arrays "values", "row_names", 
+        "col_names" and "index_name") or None ('npz' if the file name ends with .npz, 'table' otherwise)
+    """
+    import numpy as np
+
+    if format is None:
+        format = 'npz' if filename.endswith('.npz') else 'table'
+    if format == 'table':
+        with open_file_or_stdout(filename) as f:
+            matrix.to_csv(f, sep='\t', header=True, index=True, na_rep='NA')
+    elif format == 'npz':
+        index_name = [] if matrix.index.name is None else [matrix.index.name]
+        # pass a file object to prevent numpy from appending .npz to the file name
+        with open(filename, 'wb') as f:
+            np.savez(f, values=np.ascontiguousarray(matrix.values), 
+                row_names=np.asarray(matrix.index.values, dtype='str'),
+                col_names=np.asarray(matrix.columns.values, dtype='str'),
+                index_name=np.asarray(index_name, dtype='str'))
+    else:
+        raise ValueError('unknown matrix format: {}'.format(format))
+
+def _memmap_npz_array(filename, name, mmap_mode='r'):
+    """Memory-map an array stored without compression in a npz file
+    """
+    import struct
+    import zipfile
+    import numpy as np
+
+    with zipfile.ZipFile(filename, 'r') as z:
+        info = z.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(filename) as f:
+            return f[name]
+    with open(filename, 'rb') as f:
+        # skip the local file header of the zip member
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(filename, dtype=dtype, mode=mmap_mode, shape=shape,
+        order='F' if fortran_order else 'C', offset=offset)
+
+def read_matrix_values(filename, mmap_mode=None):
+    """Read values, row names and column names of a matrix as numpy arrays
+
+    Parameters
+    ----------
+    filename: str
+        Matrix file in any format supported by read_matrix
+    mmap_mode: str
+        If not None, values of a dense npz file written by write_matrix are memory-mapped 
+        with this mode (e.g. 'r') instead of loaded into memory.
+        Other formats are always loaded into memory.
+
+    Returns
+    -------
+    values: ndarray or numpy.memmap
+    row_names: ndarray
+    col_names: ndarray
+    """
+    import numpy as np
+
+    if detect_matrix_format(filename) == 'npz':
+        with np.load(filename) as f:
+            dense = 'values' in f
+            if dense:
+                row_names, col_names = f['row_names'], f['col_names']
+                if mmap_mode is None:
+                    return f['values'], row_names, col_names
+        if dense:
+            return _memmap_npz_array(filename, 'values', mmap_mode), row_names, col_names
+    matrix = read_matrix(filename)
+    return matrix.values, matrix.index.values, matrix.columns.values
+
+def read_matrix_columns(filename):
+    """Read column names of a matrix without reading its values
+    """
+    import numpy as np
+    import pandas as pd
+
+    if detect_matrix_format(filename) == 'npz':
+        with np.load(filename) as f:
+            return f['col_names']
+    return np.asarray(pd.read_table(filename, sep='\t', index_col=0, nrows=0).columns.values)
+
+def iter_matrix_chunks(filename, chunk_size=10000):
+    """Read a matrix in chunks of rows
+
+    Values of a dense npz file are memory-mapped and rows of a sparse npz file are 
+    densified chunk by chunk. Table files are parsed chunk by chunk.
+
+    Parameters
+    ----------
+    filename: str
+        Matrix file in any format supported by read_matrix. '-' for standard input (table format only).
+    chunk_size: int
+        Maximum number of rows in each chunk
+
+    Yields
+    ------
+    chunk: pandas.DataFrame
+        Consecutive rows of the matrix
+    """
+    import numpy as np
+    import pandas as pd
+
+    if detect_matrix_format(filename) == 'table':
+        with open_file_or_stdin(filename) as f:
+            for chunk in pd.read_table(f, sep='\t', index_col=0, chunksize=chunk_size):
+                yield chunk
+        return
+    if is_sparse_matrix(filename):
+        values, row_names, col_names = read_sparse_matrix(filename)
+        index_name = 'feature'
+    else:
+        with np.load(filename) as f:
+            index_name = str(f['index_name'][0]) if f['index_name'].size > 0 else None
+        values, row_names, col_names = read_matrix_values(filename, mmap_mode='r')
+    for start in range(0, values.shape[0], chunk_size):
+        end = min(start + chunk_size, values.shape[0])
+        if hasattr(values, 'toarray'):
+            chunk_values = values[start:end].toarray()
+        else:
+            chunk_values = np.array(values[start:end])
+        chunk = pd.DataFrame(chunk_values, index=row_names[start:end], columns=col_names)
+        chunk.index.name = index_name
+        yield chunk
+
+def write_matrix_chunks(filename, chunks, n_rows=None, format=None):
+    """Write a matrix from chunks of rows without concatenating them in memory
+
+    Parameters
+    ----------
+    filename: str
+        Output file. '-' for standard output (table format only).
+    chunks: iterable of pandas.DataFrame
+        Consecutive rows of the matrix with the same columns
+    n_rows: int
+        Total number of rows. Required for npz format because the shape is written before the values.
+    format: str
+        Same as write_matrix
+    """
+    import numpy as np
+
+    if format is None:
+        format = 'npz' if filename.endswith('.npz') else 'table'
+    if format == 'table':
+        with open_file_or_stdout(filename) as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, sep='\t', header=(i == 0), index=True, na_rep='NA')
+    elif format == 'npz':
+        if n_rows is None:
+            raise ValueError('number of rows is required to write npz format in chunks')
+        row_names = []
+        col_names = None
+        index_name = []
+        n_written = 0
+        # same layout as np.savez: uncompressed npy members
+        with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as z:
+            with z.open('values.npy', 'w', force_zip64=True) as f:
+                for chunk in chunks:
+                    if col_names is None:
+                        col_names = chunk.columns.values
+                        index_name = [] if chunk.index.name is None else [chunk.index.name]
+                        dtype = chunk.values.dtype
+                        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                            'fortran_order': False, 'shape': (n_rows, col_names.shape[0])})
+                    f.write(np.ascontiguousarray(chunk.values, dtype=dtype).tobytes())
+                    row_names.append(np.asarray(chunk.index.values, dtype='str'))
+                    n_written += chunk.shape[0]
+                if col_names is None:
+                    col_names = np.zeros(0, dtype='str')
+                    np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype('float64')),
+                        'fortran_order': False, 'shape': (n_rows, 0)})
+            if n_written != n_rows:
+                raise ValueError('expect {} rows but {} rows written'.format(n_rows, n_written))
+            arrays = {'row_names': np.concatenate(row_names) if row_names else np.zeros(0, dtype='str'),
+                'col_names': np.asarray(col_names, dtype='str'),
+                'index_name': np.asarray(index_name, dtype='str')}
+            for name, array in arrays.items():
+                with z.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+    else:
+        raise ValueError('unknown matrix format: {}'.format(format))
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+import argparse, sys, os, errno
+import logging
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
+
+IMPUTATION_METHODS = ('null', 'knn_count')
+BATCH_REMOVAL_METHODS = ('null', 'Combat')
+
+def filter_low(X, min_count=5, min_samples=0.2):
+    """Select features with enough expression (same as filter_low in matrix-process.R)
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+    min_count: float
+        Minimum count of a feature in a sample
+    min_samples: float
+        Minimum fraction of samples with counts above min_count
+
+    Returns
+    -------
+    keep: ndarray of bool, shape (n_features,)
+        Selected features
+    """
+    import numpy as np
+
+    return np.sum(X > min_count, axis=1) >= np.ceil(X.shape[1]*min_samples)
+
+def impute(X, method, args):
+    """Impute dropouts in a filtered count matrix (rows are features and columns are samples)
+    """
+    if method == 'null':
+        return X
+    elif method == 'knn_count':
+        from imputation import knn_impute
+
+        X_imputed, labels = knn_impute(X, n_clusters=args.impute_cluster, n_neighbors=args.n_neighbors,
+            dropout_threshold=args.dropout_threshold, jobs=args.jobs, max_memory=args.max_memory)
+        return X_imputed
+    else:
+        raise ValueError('unknown imputation method: {}'.format(method))
+
+def remove_batch(X, method, args, combat_models=None):
+    """Remove batch effects from a normalized matrix (rows are features and columns are samples)
+
+    Parameters
+    ----------
+    combat_models: dict
+        ComBat models for each batch index, which are shared by all matrices
+
+    Returns
+    -------
+    results: list of tuple (name, ndarray)
+        Corrected matrices and names used in output file names
+    """
+    import numpy as np
+
+    if method == 'null':
+        return [('null', X)]
+    elif method == 'Combat':
+        results = []
+        for batch_index, model in combat_models.items():
+            # same as matrix-process.R: correct log(X + 0.001)
+            X_corrected = np.exp(model.transform(np.log(X + 0.001)))
+            results.append(('Combat_{}'.format(batch_index), X_corrected))
+        return results
+    else:
+        raise ValueError('unknown batch removal method: {}'.format(method))
+
+def matrix_process(args):
+    from ioutils import read_matrix, write_matrix
+    from normalize import normalize_matrix, read_reference_genes, METHODS as NORMALIZATION_METHODS
+    import numpy as np
+    import pandas as pd
+
+    imputation_methods = args.imputation_methods.split(',')
+    normalization_methods = args.normalization_methods.split(',')
+    batch_removal_methods = args.batch_removal_methods.split(',')
+    for methods, supported, step in ((imputation_methods, IMPUTATION_METHODS, 'imputation'),
+            (normalization_methods, NORMALIZATION_METHODS, 'normalization'),
+            (batch_removal_methods, BATCH_REMOVAL_METHODS, 'batch removal')):
+        for method in methods:
+            if method not in supported:
+                raise ValueError('unknown {} method: {}'.format(step, method))
+    reference_genes = None
+    if 'CPM_refer' in normalization_methods:
+        if args.reference_genes is None:
+            raise ValueError('--reference-genes is required for CPM_refer normalization')
+        reference_genes = read_reference_genes(args.reference_genes)
+
+    logger.info('read count matrix: ' + args.input_file)
+    matrix = read_matrix(args.input_file)
+    combat_models = None
+    if 'Combat' in batch_removal_methods:
+        from combat import ComBat, read_batch_info
+
+        if args.batch_info is None:
+            raise ValueError('--batch-info is required for Combat batch removal')
+        # the design of each batch variable is built once for all matrices
+        combat_models = {}
+        for batch_index in args.batch_indices.split(','):
+            batch = read_batch_info(args.batch_info, int(batch_index), matrix.columns.values)
+            combat_models[batch_index] = ComBat(batch)
+    logger.info('filter features with count > {} in at least a fraction {} of samples'.format(args.filter_count, args.filter_sample))
+    keep = filter_low(matrix.values, args.filter_count, args.filter_sample)
+    matrix = matrix.loc[keep]
+    logger.info('{} features after filtering'.format(matrix.shape[0]))
+    feature_names = matrix.index.values
+
+    # each step is computed once for all downstream branches
+    X_filtered = matrix.values
+    for imputation_method in imputation_methods:
+        logger.info('impute using ' + imputation_method)
+        X_imputed = impute(X_filtered, imputation_method, args)
+        for normalization_method in normalization_methods:
+            logger.info('normalize using ' + normalization_method)
+            X_normalized = normalize_matrix(X_imputed, feature_names, normalization_method,
+                top_n=args.top_n, remove_types=args.remove_types.split(','),
+                reference_genes=reference_genes, cv_threshold=args.cv_threshold)
+            for batch_removal_method in batch_removal_methods:
+                for batch_name, X_corrected in remove_batch(X_normalized, batch_removal_method, args, combat_models):
+                    output_file = args.output_file.format(imputation_method=imputation_method,
+                        normalization_method=normalization_method, batch_removal_method=batch_name)
+                    logger.info('write matrix: ' + output_file)
+                    write_matrix(output_file, pd.DataFrame(X_corrected, index=matrix.index, columns=matrix.columns))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Matrix processing pipeline (filter, imputation, normalization and batch removal)')
+    parser.add_argument('--input-file', '-i', type=str, required=True,
+        help='input count matrix (rows are features and columns are samples). '
+        'Tab-separated or npz format (detected automatically)')
+    parser.add_argument('--output-file', '-o', type=str, required=True,
+        help='template of output file names with placeholders {imputation_method}, '
+        '{normalization_method} and {batch_removal_method}. '
+        'One file is written for each combination of methods. '
+        'Names of Combat batch removal are Combat_{batch_index}')
+    parser.add_argument('--filter-count', type=float, default=5,
+        help='minimum count of a feature in a sample')
+    parser.add_argument('--filter-sample', type=float, default=0.2,
+        help='minimum fraction of samples with counts above --filter-count')
+    parser.add_argument('--imputation-methods', type=str, default='null',
+        help='comma-separated list of imputation methods ({})'.format(', '.join(IMPUTATION_METHODS)))
+    parser.add_argument('--impute-cluster', type=int, default=5,
+        help='number of sample clusters for knn_count imputation')
+    parser.add_argument('--n-neighbors', type=int, default=10,
+        help='number of nearest neighbors within the cluster for knn_count imputation')
+    parser.add_argument('--dropout-threshold', type=float, default=0.5,
+        help='minimum fraction of neighbors with non-zero counts to impute a zero count for knn_count imputation')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes for knn_count imputation')
+    parser.add_argument('--max-memory', type=float, default=1024,
+        help='memory budget (in MB) of chunks of features for knn_count imputation')
+    parser.add_argument('--normalization-methods', type=str, default='CPM',
+        help='comma-separated list of normalization methods (see normalize.py)')
+    parser.add_argument('--batch-removal-methods', type=str, default='null',
+        help='comma-separated list of batch removal methods ({})'.format(', '.join(BATCH_REMOVAL_METHODS)))
+    parser.add_argument('--batch-info', type=str,
+        help='batch info file for Combat (sample IDs in the first column)')
+    parser.add_argument('--batch-indices', type=str, default='1',
+        help='comma-separated list of 1-based indices of batch variables in the batch info file for Combat')
+    parser.add_argument('--top-n', type=int, default=20,
+        help='number of top features scaled separately for CPM_top')
+    parser.add_argument('--remove-types', type=str, default='miRNA,piRNA',
+        help='comma-separated list of RNA types excluded from library sizes for CPM_rm')
+    parser.add_argument('--reference-genes', type=str,
+        help='reference gene file for CPM_refer (gene IDs in the second column)')
+    parser.add_argument('--cv-threshold', type=float, default=0.5,
+        help='maximum coefficient of variation of reference genes for CPM_refer')
+
+    args = parser.parse_args()
+    logger = logging.getLogger('matrix_process')
+    matrix_process(args)
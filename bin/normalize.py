@@ -3,28 +3,359 @@ import argparse, sys, os, errno
 import logging
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
 
-def normalize(args):
-    from ioutils import open_file_or_stdin, open_file_or_stdout
+METHODS = ('CPM', 'TMM', 'RLE', 'UQ', 'CPM_top', 'CPM_rm', 'CPM_refer', 'null')
+METHOD_ALIASES = {'cpm': 'CPM'}
+
+def sparse_cpm(matrix, axis=0):
+    """CPM normalization of a sparse count matrix
+
+    Parameters
+    ----------
+    matrix: scipy.sparse matrix
+        Count matrix
+    axis: int
+        0 if columns are samples (library sizes are column sums), 1 if rows are samples
+    """
+    import numpy as np
+    from scipy import sparse
+
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    lib_sizes = np.asarray(matrix.sum(axis=axis)).ravel()
+    # scale non-zero values by library sizes of their samples
+    if axis == 0:
+        matrix.data = 1e6*matrix.data/lib_sizes[matrix.indices]
+    else:
+        matrix.data = 1e6*matrix.data/np.repeat(lib_sizes, np.diff(matrix.indptr))
+    return matrix
+
+def cpm_by_rows(X, rows=None):
+    """CPM normalization using counts of selected rows (features) as library sizes
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+    rows: array of int or bool
+        Rows used to compute library sizes. All rows are used if None.
+    """
+    import numpy as np
+
+    lib_sizes = np.nansum(X if rows is None else X[rows], axis=0)
+    return 1e6*X/lib_sizes
+
+def cpm_top(X, top_n=20):
+    """CPM normalization that scales the top n features (ranked by total counts) and 
+    other features by library sizes computed separately
+    """
+    import numpy as np
+
+    if X.shape[0] < top_n:
+        raise ValueError('too few features for CPM_top normalization')
+    # stable sort keeps the original order of ties
+    order = np.argsort(-np.sum(X, axis=1), kind='stable')
+    is_top = np.zeros(X.shape[0], dtype=bool)
+    is_top[order[:top_n]] = True
+    Y = np.empty(X.shape, dtype=np.float64)
+    Y[is_top] = cpm_by_rows(X[is_top])
+    Y[~is_top] = cpm_by_rows(X[~is_top])
+    return Y
+
+def cpm_remove_types(X, feature_names, remove_types):
+    """CPM normalization excluding features of some RNA types from library sizes
+
+    RNA types are the second field of feature names separated by '|'
+    """
+    import pandas as pd
+
+    gene_types = pd.Series(feature_names).str.split('|').str[1].values
+    return cpm_by_rows(X, ~pd.Series(gene_types).isin(remove_types).values)
+
+def cpm_reference(X, feature_names, reference_genes, cv_threshold=0.5):
+    """CPM normalization using reference genes with coefficient of variation below a threshold
+
+    Gene IDs are the first field of feature names separated by '|'
+    """
+    import numpy as np
+    import pandas as pd
+
+    gene_ids = pd.Series(feature_names).str.split('|').str[0]
+    is_reference = gene_ids.isin(reference_genes).values
+    if not np.any(is_reference):
+        raise ValueError('cannot find any reference genes in the matrix for CPM_refer normalization')
+    reference = np.nonzero(is_reference)[0]
+    X_ref = X[reference]
+    cv = np.std(X_ref, axis=1, ddof=1)/np.mean(X_ref, axis=1)
+    reference = reference[cv < cv_threshold]
+    if reference.shape[0] == 0:
+        raise ValueError('no reference genes have coefficient of variation below {}'.format(cv_threshold))
+    return cpm_by_rows(X, reference)
+
+def upper_quartile_factors(X, lib_sizes):
+    import numpy as np
+
+    # same as quantile(type=7) in R
+    return np.percentile(X, 75, axis=0)/lib_sizes
+
+def tmm_factor(obs, ref, lib_size_obs, lib_size_ref, logratio_trim=0.3, sum_trim=0.05):
+    """TMM normalization factor of one sample against the reference sample (calcFactorTMM in edgeR)
+    """
+    import numpy as np
+    from scipy.stats import rankdata
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio = np.log2((obs/lib_size_obs)/(ref/lib_size_ref))
+        abs_expr = (np.log2(obs/lib_size_obs) + np.log2(ref/lib_size_ref))/2
+        variance = (lib_size_obs - obs)/lib_size_obs/obs + (lib_size_ref - ref)/lib_size_ref/ref
+    finite = np.isfinite(log_ratio) & np.isfinite(abs_expr)
+    log_ratio, abs_expr, variance = log_ratio[finite], abs_expr[finite], variance[finite]
+    if (log_ratio.shape[0] == 0) or (np.max(np.abs(log_ratio)) < 1e-6):
+        return 1.0
+    n = log_ratio.shape[0]
+    lo_l = np.floor(n*logratio_trim) + 1
+    hi_l = n + 1 - lo_l
+    lo_s = np.floor(n*sum_trim) + 1
+    hi_s = n + 1 - lo_s
+    # ranks of ties are averaged as in R
+    rank_ratio = rankdata(log_ratio)
+    rank_expr = rankdata(abs_expr)
+    keep = (rank_ratio >= lo_l) & (rank_ratio <= hi_l) & (rank_expr >= lo_s) & (rank_expr <= hi_s)
+    f = np.nansum(log_ratio[keep]/variance[keep])/np.nansum(1.0/variance[keep])
+    if np.isnan(f):
+        f = 0.0
+    return 2.0**f
+
+def norm_factors(X, method='TMM'):
+    """Normalization factors of samples (calcNormFactors in edgeR)
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+    method: str
+        'TMM', 'RLE' or 'UQ' (upper quartile)
+
+    Returns
+    -------
+    factors: ndarray, shape (n_samples,)
+        Normalization factors scaled to a geometric mean of 1
+    """
+    import numpy as np
+
+    lib_sizes = np.sum(X, axis=0)
+    X = X[np.any(X > 0, axis=1)]
+    if method == 'TMM':
+        f75 = upper_quartile_factors(X, lib_sizes)
+        if np.median(f75) < 1e-20:
+            ref_column = np.argmax(np.sum(np.sqrt(X), axis=0))
+        else:
+            ref_column = np.argmin(np.abs(f75 - np.mean(f75)))
+        factors = np.array([tmm_factor(X[:, i], X[:, ref_column], lib_sizes[i], lib_sizes[ref_column])
+            for i in range(X.shape[1])])
+    elif method == 'RLE':
+        with np.errstate(divide='ignore'):
+            geo_means = np.exp(np.mean(np.log(X), axis=1))
+        valid = geo_means > 0
+        factors = np.median(X[valid]/geo_means[valid, np.newaxis], axis=0)/lib_sizes
+    elif method == 'UQ':
+        factors = upper_quartile_factors(X, lib_sizes)
+    else:
+        raise ValueError('unknown normalization factor method: {}'.format(method))
+    return factors/np.exp(np.mean(np.log(factors)))
+
+def scale_by_norm_factors(X, factors):
+    """Divide counts by size factors (library sizes times normalization factors centered at 1)
+    as in scater::normalise
+    """
+    import numpy as np
+
+    size_factors = factors*np.sum(X, axis=0)
+    size_factors = size_factors/np.mean(size_factors)
+    return X/size_factors
+
+def read_reference_genes(filename):
+    """Read gene IDs in the second column of a reference gene file
+    """
+    import pandas as pd
+
+    return pd.read_table(filename, sep='\t', index_col=0, dtype='str').iloc[:, 0].values
+
+def normalize_matrix(X, feature_names, method, top_n=20, remove_types=('miRNA', 'piRNA'),
+        reference_genes=None, cv_threshold=0.5):
+    """Normalize a dense count matrix
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_features, n_samples)
+        Count matrix
+    feature_names: array of str
+        Feature names (gene_id|gene_type|...)
+    method: str
+        One of METHODS
+    top_n: int
+        Number of top features for CPM_top
+    remove_types: list of str
+        RNA types excluded from library sizes for CPM_rm
+    reference_genes: list of str
+        Gene IDs of reference genes for CPM_refer
+    cv_threshold: float
+        Maximum coefficient of variation of reference genes for CPM_refer
+    """
+    if method == 'CPM':
+        return cpm_by_rows(X)
+    elif method in ('TMM', 'RLE', 'UQ'):
+        return scale_by_norm_factors(X, norm_factors(X, method))
+    elif method == 'CPM_top':
+        return cpm_top(X, top_n)
+    elif method == 'CPM_rm':
+        return cpm_remove_types(X, feature_names, remove_types)
+    elif method == 'CPM_refer':
+        if reference_genes is None:
+            raise ValueError('reference genes are required for CPM_refer normalization')
+        return cpm_reference(X, feature_names, reference_genes, cv_threshold)
+    elif method == 'null':
+        return X
+    else:
+        raise ValueError('unknown normalization method: {}'.format(method))
+
+def normalize_dense(args, methods, output_format):
+    from ioutils import read_matrix, write_matrix
+    import numpy as np
     import pandas as pd
 
-    with open_file_or_stdin(args.input_file) as f:
-        matrix = pd.read_table(f, sep='\t', index_col=0)
-    if args.method == 'cpm':
-        matrix = 1e6*matrix.astype('float')/matrix.sum(axis=0)
-    with open_file_or_stdout(args.output_file) as f:
-        matrix.to_csv(f, sep='\t', header=True, index=True, na_rep='NA')
+    logger.info('read matrix: ' + args.input_file)
+    matrix = read_matrix(args.input_file)
+    if args.transpose:
+        matrix = matrix.T
+    X = matrix.values.astype(np.float64)
+    reference_genes = None
+    if 'CPM_refer' in methods:
+        if args.reference_genes is None:
+            raise ValueError('--reference-genes is required for CPM_refer normalization')
+        reference_genes = read_reference_genes(args.reference_genes)
+    for method in methods:
+        logger.info('normalize using ' + method)
+        if method == 'null':
+            normalized = matrix
+        else:
+            normalized = pd.DataFrame(normalize_matrix(X, matrix.index.values, method,
+                top_n=args.top_n, remove_types=args.remove_types.split(','),
+                reference_genes=reference_genes, cv_threshold=args.cv_threshold),
+                index=matrix.index, columns=matrix.columns)
+        if args.transpose:
+            normalized = normalized.T
+        output_file = args.output_file.replace('{method}', method)
+        logger.info('write normalized matrix: ' + output_file)
+        write_matrix(output_file, normalized, format=output_format)
+
+def normalize_sparse(args, output_format):
+    from ioutils import write_matrix, read_sparse_matrix, write_sparse_matrix
+    import pandas as pd
+
+    # normalize a sparse count matrix without densifying
+    logger.info('read sparse matrix: ' + args.input_file)
+    matrix, row_names, col_names = read_sparse_matrix(args.input_file)
+    matrix = sparse_cpm(matrix, axis=1 if args.transpose else 0)
+    if output_format == 'npz':
+        write_sparse_matrix(args.output_file, matrix, row_names, col_names)
+    else:
+        matrix = pd.DataFrame(matrix.toarray(), index=row_names, columns=col_names)
+        matrix.index.name = 'feature'
+        write_matrix(args.output_file, matrix, format='table')
+
+def normalize(args):
+    from ioutils import is_sparse_matrix, read_matrix_columns, iter_matrix_chunks, write_matrix_chunks
+    import numpy as np
+    import tempfile
+    import shutil
+
+    methods = []
+    for method in args.method.split(','):
+        method = METHOD_ALIASES.get(method, method)
+        if method not in methods:
+            methods.append(method)
+    for method in methods:
+        if method not in METHODS:
+            raise ValueError('unknown normalization method: {}'.format(method))
+    if (len(methods) > 1) and ('{method}' not in args.output_file):
+        raise ValueError('output file name should contain "{method}" when multiple methods are given')
+    if len(methods) == 1:
+        args.output_file = args.output_file.replace('{method}', methods[0])
+    output_format = args.output_format or ('npz' if args.output_file.endswith('.npz') else 'table')
+    if methods != ['CPM']:
+        # other methods require the whole matrix, which is shared by all methods
+        normalize_dense(args, methods, output_format)
+        return
+    if (args.input_file != '-') and is_sparse_matrix(args.input_file):
+        normalize_sparse(args, output_format)
+        return
+
+    input_file = args.input_file
+    spool = None
+    if input_file == '-':
+        # spool stdin to a temporary file for the second pass
+        spool = tempfile.NamedTemporaryFile(mode='wb', suffix='.txt')
+        shutil.copyfileobj(sys.stdin.buffer, spool)
+        spool.flush()
+        input_file = spool.name
+    try:
+        n_columns = read_matrix_columns(input_file).shape[0]
+        # number of rows in each chunk within the memory budget (8 bytes for each value)
+        chunk_size = max(1, int(args.chunk_memory*1024*1024)//(8*max(n_columns, 1)))
+        logger.info('{} columns, {} rows in each chunk'.format(n_columns, chunk_size))
+
+        # first pass: library sizes of samples and number of rows
+        n_rows = 0
+        lib_sizes = np.zeros(n_columns)
+        if (not args.transpose) or (output_format == 'npz'):
+            logger.info('read matrix (first pass): ' + args.input_file)
+            for chunk in iter_matrix_chunks(input_file, chunk_size):
+                if not args.transpose:
+                    lib_sizes += chunk.values.sum(axis=0)
+                n_rows += chunk.shape[0]
+            logger.info('{} rows'.format(n_rows))
+
+        # second pass: normalize each chunk
+        def normalized_chunks():
+            for chunk in iter_matrix_chunks(input_file, chunk_size):
+                if args.transpose:
+                    # rows are samples
+                    chunk = 1e6*chunk.astype('float').div(chunk.sum(axis=1), axis=0)
+                else:
+                    chunk = 1e6*chunk.astype('float')/lib_sizes
+                yield chunk
+
+        logger.info('write normalized matrix: ' + args.output_file)
+        write_matrix_chunks(args.output_file, normalized_chunks(), n_rows=n_rows, format=output_format)
+    finally:
+        if spool is not None:
+            spool.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Normalization module')
     parser.add_argument('--input-file', '-i', type=str, default='-',
-        help='input feature matrix (rows are samples and columns are features')
-    parser.add_argument('--method', '-m', type=str, default='cpm',
-        choices=('cpm',), help='normalization method')
-    parser.add_argument('--transpose', '-t', action='store_true', 
-        help='transpose the matrix before normalization')
+        help='input feature matrix (rows are features and columns are samples). '
+        'Tab-separated or npz format (detected automatically)')
+    parser.add_argument('--method', '-m', type=str, default='CPM',
+        help='comma-separated list of normalization methods ({}). '
+        'CPM alone is computed in chunks of rows, other methods load the matrix once for all methods'.format(', '.join(METHODS)))
+    parser.add_argument('--transpose', '-t', action='store_true',
+        help='rows of the input matrix are samples and columns are features')
     parser.add_argument('--output-file', '-o', type=str, default='-',
-        help='normalized matrix file')
-    
+        help='normalized matrix file. "{method}" in the file name is replaced by the method name '
+        '(required for multiple methods)')
+    parser.add_argument('--output-format', type=str, choices=('table', 'npz'),
+        help='output matrix format (default: npz if the output file name ends with .npz, otherwise table)')
+    parser.add_argument('--chunk-memory', type=float, default=256,
+        help='memory budget (in MB) of the chunk of rows normalized at a time')
+    parser.add_argument('--top-n', type=int, default=20,
+        help='number of top features scaled separately for CPM_top')
+    parser.add_argument('--remove-types', type=str, default='miRNA,piRNA',
+        help='comma-separated list of RNA types excluded from library sizes for CPM_rm')
+    parser.add_argument('--reference-genes', type=str,
+        help='reference gene file for CPM_refer (gene IDs in the second column)')
+    parser.add_argument('--cv-threshold', type=float, default=0.5,
+        help='maximum coefficient of variation of reference genes for CPM_refer')
+
     args = parser.parse_args()
     logger = logging.getLogger('normalize')
     normalize(args)
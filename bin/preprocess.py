@@ -9,107 +9,440 @@ def command_handler(f):
     command_handlers[f.__name__] = f
     return f
 
-def read_gtf(filename):
-    from ioutils import open_file_or_stdin
+def parse_gtf_attributes(s):
+    """Parse the attribute column (column 9) of a GTF line into a dict
+    """
+    attrs = {}
+    for a in s.split(';')[:-1]:
+        a = a.strip()
+        i = a.find(' ')
+        key = a[:i]
+        val = a[(i + 1):].strip('"')
+        attrs[key] = val
+    return attrs
 
-    with open_file_or_stdin(filename) as fin:
+def open_gtf_file(filename):
+    """Open a plain or gzip-compressed GTF file in text mode. '-' is standard input
+    """
+    import gzip
+
+    if filename == '-':
+        return sys.stdin
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    else:
+        return open(filename, 'r')
+
+def read_gtf_serial(filename):
+    with open_gtf_file(filename) as fin:
         lineno = 0
         for line in fin:
             lineno += 1
             c = line.strip().split('\t')
             if c[0].startswith('#'):
                 continue
-            attrs = {}
-            for a in c[8].split(';')[:-1]:
-                a = a.strip()
-                i = a.find(' ')
-                key = a[:i]
-                val = a[(i + 1):].strip('"')
-                attrs[key] = val
+            attrs = parse_gtf_attributes(c[8])
             gene_id = attrs.get('gene_id')
             if gene_id is None:
                 raise ValueError('gene_id not found in GTF file at line {}'.format(lineno))
             yield (c, attrs, line)
 
+def split_gtf_chunks(filename, chunk_size=16*1024*1024):
+    """Split a GTF file into chunks of complete lines
+
+    Plain files are split into line-aligned byte ranges that are read by workers.
+    Compressed files and standard input cannot be seeked, 
+    so lines are read here and sent to workers.
+
+    Yields
+    ------
+    chunk: tuple
+        (filename, start, end) for byte ranges or (None, lines, None) for lines
+    """
+    if (filename == '-') or filename.endswith('.gz'):
+        with open_gtf_file(filename) as fin:
+            lines = []
+            size = 0
+            for line in fin:
+                lines.append(line)
+                size += len(line)
+                if size >= chunk_size:
+                    yield (None, lines, None)
+                    lines = []
+                    size = 0
+            if lines:
+                yield (None, lines, None)
+    else:
+        file_size = os.path.getsize(filename)
+        with open(filename, 'rb') as fin:
+            start = 0
+            while start < file_size:
+                fin.seek(min(start + chunk_size, file_size))
+                # move to the start of the next line
+                fin.readline()
+                end = fin.tell()
+                yield (filename, start, end)
+                start = end
+
+def iter_gtf_chunk(chunk):
+    """Parse GTF records in a chunk created by split_gtf_chunks
+
+    Yields
+    ------
+    record: tuple
+        (c, attrs, line) as read_gtf
+    """
+    filename, start, end = chunk
+    if filename is None:
+        lines = start
+    else:
+        with open(filename, 'rb') as fin:
+            fin.seek(start)
+            lines = fin.read(end - start).decode('utf-8').splitlines(True)
+    for line in lines:
+        c = line.strip().split('\t')
+        if c[0].startswith('#'):
+            continue
+        attrs = parse_gtf_attributes(c[8])
+        if 'gene_id' not in attrs:
+            raise ValueError('gene_id not found in GTF record: ' + line.strip())
+        yield (c, attrs, line)
+
+def _parse_gtf_chunk(chunk):
+    return list(iter_gtf_chunk(chunk))
+
+def _map_gtf_chunk(task):
+    mapper, chunk = task
+    return mapper(iter_gtf_chunk(chunk))
+
+def read_gtf(filename, jobs=1):
+    """Read records from a plain or gzip-compressed GTF file
+
+    Parameters
+    ----------
+    filename: str
+        GTF file name or '-' for standard input
+    jobs: int
+        Number of processes to parse the file in parallel. Records are returned in file order.
+
+    Yields
+    ------
+    c: list
+        Columns of the record
+    attrs: dict
+        Attributes of the record
+    line: str
+        The original line
+    """
+    from multiprocessing import Pool
+
+    if jobs <= 1:
+        for record in read_gtf_serial(filename):
+            yield record
+        return
+    pool = Pool(processes=jobs)
+    try:
+        for records in pool.imap(_parse_gtf_chunk, split_gtf_chunks(filename)):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+def reduce_gtf(filename, mapper, reducer, initial, jobs=1):
+    """Aggregate records of a GTF file in parallel
+
+    Parameters
+    ----------
+    filename: str
+        GTF file name or '-' for standard input
+    mapper: callable
+        mapper(records) returns a partial result of an iterator of records (see read_gtf).
+        Must be a module-level function (or functools.partial of it) if jobs > 1.
+    reducer: callable
+        reducer(result, partial) combines partial results in file order
+    initial: object
+        Initial value of result
+    jobs: int
+        Number of processes to parse the file and run mapper in parallel
+    
+    Returns
+    -------
+    result: object
+        Return value of the last call to reducer
+    """
+    from multiprocessing import Pool
+
+    if jobs <= 1:
+        return reducer(initial, mapper(read_gtf_serial(filename)))
+    result = initial
+    pool = Pool(processes=jobs)
+    try:
+        tasks = ((mapper, chunk) for chunk in split_gtf_chunks(filename))
+        for partial in pool.imap(_map_gtf_chunk, tasks):
+            result = reducer(result, partial)
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+GTF_COLUMNS = ['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame']
+
+def _gtf_table_mapper(records, keep_lines=False):
+    columns = [[] for i in range(8)]
+    attributes = {}
+    lines = [] if keep_lines else None
+    n_records = 0
+    for c, attrs, line in records:
+        for i in range(8):
+            columns[i].append(c[i])
+        for key, val in attrs.items():
+            values = attributes.get(key)
+            if values is None:
+                values = attributes[key] = [None]*n_records
+            values.append(val)
+        n_records += 1
+        for values in attributes.values():
+            if len(values) < n_records:
+                values.append(None)
+        if keep_lines:
+            lines.append(line)
+    return columns, attributes, lines, n_records
+
+def _gtf_table_reducer(result, partial):
+    columns, attributes, lines, n_records = partial
+    if result is None:
+        return partial
+    for i in range(8):
+        result[0][i] += columns[i]
+    for key in attributes.keys():
+        if key not in result[1]:
+            result[1][key] = [None]*result[3]
+    for key, values in result[1].items():
+        values += attributes.get(key, [None]*n_records)
+    if lines is not None:
+        result[2].extend(lines)
+    return result[0], result[1], result[2], result[3] + n_records
+
+def parse_gtf_table(filename, keep_lines=False, jobs=1):
+    """Parse a GTF file into a columnar table
+
+    Returns
+    -------
+    table: pandas.DataFrame
+        One row for each GTF record. Columns are the first 8 GTF columns 
+        ('start' and 'end' are integers) and one column for each attribute key.
+        String columns are categorical.
+    lines: list of str or None
+        Original GTF records if keep_lines is True
+    """
+    import numpy as np
+    import pandas as pd
+    from functools import partial
+
+    columns, attributes, lines, n_records = reduce_gtf(filename, 
+        partial(_gtf_table_mapper, keep_lines=keep_lines), _gtf_table_reducer, None, jobs=jobs)
+    table = {}
+    for name, values in zip(GTF_COLUMNS, columns):
+        if name in ('start', 'end'):
+            table[name] = np.asarray(values, dtype=np.int64)
+        else:
+            table[name] = pd.Categorical(values)
+    for key, values in attributes.items():
+        table[key] = pd.Categorical(values)
+    return pd.DataFrame(table, columns=GTF_COLUMNS + list(attributes.keys())), lines
+
+def gtf_index_filename(filename):
+    return filename + '.gtfidx'
+
+def save_gtf_index(table, filename):
+    """Save a GTF table in a directory of numpy arrays (npz format)
+
+    Integer columns are stored as is. Categorical columns are dictionary-encoded
+    as integer codes (-1 for missing values) and an array of categories.
+    """
+    import numpy as np
+
+    arrays = {'columns': np.asarray(table.columns.values, dtype='str')}
+    for i, name in enumerate(table.columns):
+        column = table[name]
+        if name in ('start', 'end'):
+            arrays['{}.values'.format(i)] = column.values
+        else:
+            arrays['{}.codes'.format(i)] = column.cat.codes.values.astype(np.int32)
+            arrays['{}.categories'.format(i)] = np.asarray(column.cat.categories.values, dtype='str')
+    # pass a file object to prevent numpy from appending .npz to the file name
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+def load_gtf_index(filename):
+    """Load a GTF table saved by save_gtf_index
+    """
+    import numpy as np
+    import pandas as pd
+
+    table = {}
+    with np.load(filename) as f:
+        columns = f['columns'].tolist()
+        for i, name in enumerate(columns):
+            if name in ('start', 'end'):
+                table[name] = f['{}.values'.format(i)]
+            else:
+                table[name] = pd.Categorical.from_codes(f['{}.codes'.format(i)], 
+                    categories=f['{}.categories'.format(i)].astype('object'))
+    return pd.DataFrame(table, columns=columns)
+
+def read_gtf_table(filename, keep_lines=False, jobs=1):
+    """Read a GTF file as a columnar table
+
+    Use the index file created by the gtf_index command if it is newer than the GTF file.
+    Otherwise parse the GTF file.
+    
+    Returns
+    -------
+    table: pandas.DataFrame
+        GTF records (see parse_gtf_table)
+    lines: list of str or None
+        Original GTF records if keep_lines is True and the input is read from stdin.
+        Records of other files can be read by iter_gtf_lines.
+    """
+    if filename != '-':
+        index_file = gtf_index_filename(filename)
+        if os.path.exists(index_file) and (os.path.getmtime(index_file) >= os.path.getmtime(filename)):
+            logger.info('read GTF index: ' + index_file)
+            return load_gtf_index(index_file), None
+    logger.info('parse GTF file: ' + filename)
+    return parse_gtf_table(filename, keep_lines=keep_lines and (filename == '-'), jobs=jobs)
+
+def iter_gtf_lines(filename, lines=None):
+    """Iterate over original GTF records (excluding comment lines) in the same order as read_gtf_table
+    """
+    if lines is not None:
+        for line in lines:
+            yield line
+        return
+    with open_gtf_file(filename) as fin:
+        for line in fin:
+            if line.strip().startswith('#'):
+                continue
+            yield line
+
+def get_gtf_attribute(table, key):
+    """Get an attribute column as an object array. Missing values are None
+    """
+    import numpy as np
+
+    if key not in table.columns:
+        return np.full(table.shape[0], None, dtype='object')
+    values = np.array(table[key].astype('object').values, dtype='object')
+    values[table[key].isnull().values] = None
+    return values
+
+@command_handler
+def gtf_index(args):
+    output_file = args.output_file
+    if output_file is None:
+        output_file = gtf_index_filename(args.input_file)
+    logger.info('read GTF file: ' + args.input_file)
+    table, lines = parse_gtf_table(args.input_file, jobs=args.jobs)
+    logger.info('number of records: {}, number of attributes: {}'.format(
+        table.shape[0], table.shape[1] - len(GTF_COLUMNS)))
+    logger.info('write GTF index: ' + output_file)
+    save_gtf_index(table, output_file)
+
 @command_handler
 def extract_gene(args):
+    import pandas as pd
     from ioutils import open_file_or_stdout
 
     feature = args.feature
-    genes = {}
     logger.info('read GTF file: ' + args.input_file)
-    for c, attrs, line in read_gtf(args.input_file):
-        if c[2] != feature:
-            continue
-        gene_id = attrs.get('gene_id')
-        gene = genes.get(gene_id)
-        if gene is None:
-            gene = [c[0], int(c[3]) - 1, int(c[4]), gene_id, 0, c[6]]
-            genes[gene_id] = gene
-        else:
-            gene[1] = min(gene[1], int(c[3]) - 1)
-            gene[2] = max(gene[2], int(c[4]))
+    table, lines = read_gtf_table(args.input_file, jobs=args.jobs)
+    table = table[(table['feature'] == feature).values]
+    gene_ids = get_gtf_attribute(table, 'gene_id')
+    grouped = pd.DataFrame({'chrom': table['seqname'].astype('object').values,
+        'start': table['start'].values - 1, 'end': table['end'].values,
+        'strand': table['strand'].astype('object').values}).groupby(gene_ids, sort=False)
+    genes = pd.DataFrame({'chrom': grouped['chrom'].first(),
+        'start': grouped['start'].min(), 'end': grouped['end'].max()})
+    genes['name'] = genes.index.values
+    genes['score'] = 0
+    genes['strand'] = grouped['strand'].first()
     
-    logger.info('number of genes: {}'.format(len(genes)))
+    logger.info('number of genes: {}'.format(genes.shape[0]))
     logger.info('write BED file: ' + args.output_file)
     with open_file_or_stdout(args.output_file) as fout:
-        for gene_id, gene in genes.items():
-            fout.write('\t'.join(map(str, gene)))
-            fout.write('\n')
+        genes.to_csv(fout, sep='\t', header=False, index=False)
 
 
 @command_handler
 def fix_gtf(args):
+    import tempfile
     from ioutils import open_file_or_stdout
-    from collections import defaultdict
-    # strand of exons grouped by transcript_id
-    strands = defaultdict(list)
 
-    feature = args.feature
-    lines = []
-    logger.info('read GTF file: ' + args.input_file)
-    for c, attrs, line in read_gtf(args.input_file):
-        if c[2] in ('transcript', 'exon'):
-            transcript_id = attrs.get('transcript_id')
-            if transcript_id is None:
-                raise ValueError('transcript_id not found in GTF file at line {}'.format(lineno))
-            lines.append((transcript_id, line))
-        else:
-            transcript_id = attrs.get('transcript_id')
+    # strands of transcripts are encoded as bit flags
+    strand_flags = {'+': 1, '-': 2}
+    def iter_records(fin, spool=None):
+        lineno = 0
+        for line in fin:
+            if spool is not None:
+                spool.write(line)
+            lineno += 1
+            c = line.strip().split('\t')
+            if c[0].startswith('#'):
+                continue
+            if c[2] not in ('transcript', 'exon'):
+                continue
+            transcript_id = parse_gtf_attributes(c[8]).get('transcript_id')
             if transcript_id is None:
                 raise ValueError('transcript_id not found in GTF file at line {}'.format(lineno))
-            strands[transcript_id].append(c[6])
-    invalid_transcripts = set()
-    for transcript_id, strands_tx in strands.items():
-        strands_tx = set(strands_tx)
-        # remove transcripts without strand information
-        if '.' in strands_tx:
-            invalid_transcripts.add(transcript_id)
-        # remove transcripts with exon on different strands
-        elif len(strands_tx) != 1:
-            invalid_transcripts.add(transcript_id)
-    
-    logger.info('number of transcripts: {}'.format(len(strands)))
-    logger.info('number of invalid transcripts: {}'.format(len(invalid_transcripts)))
-    logger.info('write GTF file: ' + args.output_file)
-    with open_file_or_stdout(args.output_file) as fout:
-        for transcript_id, line in lines:
-            if transcript_id not in invalid_transcripts:
-                fout.write(line)
+            yield c, transcript_id, line
 
+    if args.input_file == '-':
+        # spool stdin to a temporary file for the second pass
+        fin = tempfile.TemporaryFile(mode='w+')
+    else:
+        fin = open(args.input_file, 'r')
+    with fin:
+        # first pass: strands grouped by transcript_id
+        strands = {}
+        logger.info('read GTF file: ' + args.input_file)
+        records = iter_records(sys.stdin, spool=fin) if args.input_file == '-' else iter_records(fin)
+        for c, transcript_id, line in records:
+            strands[transcript_id] = strands.get(transcript_id, 0) | strand_flags.get(c[6], 4)
+        # remove transcripts without strand information or with exons on different strands
+        invalid_transcripts = set(transcript_id for transcript_id, flags in strands.items() if flags not in (1, 2))
+        logger.info('number of transcripts: {}'.format(len(strands)))
+        logger.info('number of invalid transcripts: {}'.format(len(invalid_transcripts)))
+        del strands
+
+        # second pass: write records of valid transcripts
+        fin.seek(0)
+        logger.info('write GTF file: ' + args.output_file)
+        with open_file_or_stdout(args.output_file) as fout:
+            for c, transcript_id, line in iter_records(fin):
+                if transcript_id not in invalid_transcripts:
+                    fout.write(line)
 
 @command_handler
 def transcript_counts(args):
     import pysam
     import numpy as np
-    from ioutils import open_file_or_stdout
-    from collections import defaultdict
+    from ioutils import open_file_or_stdout, bam_has_index, read_bam_index_counts, open_alignment_file
+    from collections import OrderedDict, defaultdict
 
     logger.info('read input transcript BAM file: ' + args.input_file)
-    sam = pysam.AlignmentFile(args.input_file, "rb")
-    counts = defaultdict(int)
-    for read in sam:
-        counts[read.reference_name] += 1
+    if bam_has_index(args.input_file):
+        logger.info('get read counts from BAM index statistics')
+        # all records placed on a reference are counted
+        references, mapped = read_bam_index_counts(args.input_file, include_unmapped=True)
+        counts = OrderedDict((name, count) for name, count in zip(references, mapped) if count > 0)
+    else:
+        logger.info('count reads in BAM file')
+        sam = open_alignment_file(args.input_file, "rb", threads=args.threads)
+        counts = defaultdict(int)
+        for read in sam:
+            counts[read.reference_name] += 1
     
     logger.info('create output file: ' + args.output_file)
     with open_file_or_stdout(args.output_file) as fout:
@@ -118,196 +451,354 @@ def transcript_counts(args):
 
 @command_handler
 def extract_longest_transcript(args):
-    from ioutils import open_file_or_stdin, open_file_or_stdout
-    from collections import defaultdict
-    from functools import partial
+    import numpy as np
+    import pandas as pd
+    from ioutils import open_file_or_stdout
 
     feature = args.feature
-    genes = defaultdict(partial(defaultdict, int))
-    lines = []
     logger.info('read gtf file: ' + args.input_file)
-    with open_file_or_stdin(args.input_file) as fin:
-        lineno = 0
-        for line in fin:
-            lineno += 1
-            c = line.strip().split('\t')
-            if c[0].startswith('#'):
-                continue
-            if c[2] != feature:
-                lines.append(('#other#', line))
-                continue
-            attrs = {}
-            for a in c[8].split(';')[:-1]:
-                a = a.strip()
-                i = a.find(' ')
-                key = a[:i]
-                val = a[(i + 1):].strip('"')
-                attrs[key] = val
-            transcript_id = attrs.get('transcript_id')
-            if transcript_id is None:
-                raise ValueError('transcript_id not found in GTF file at line {}'.format(lineno))
-            gene_id = attrs.get('gene_id')
-            if gene_id is None:
-                raise ValueError('gene_id not found in GTF file at line {}'.format(lineno))
-            lines.append((transcript_id, line))
-            genes[gene_id][transcript_id] += int(c[4]) - int(c[3]) + 1
-    kept_transcripts = set()
-    kept_transcripts.add('#other#')
-    for gene_id, gene in genes.items():
-        max_length = 0
-        max_transcript = None
-        for transcript_id, length in gene.items():
-            if length > max_length:
-                max_length = length
-                max_transcript = transcript_id
-        kept_transcripts.add(transcript_id)
-
-    logger.info('number of genes: {}'.format(len(genes)))
-    logger.info('number of transcripts: {}'.format(sum(map(len, genes.values()))))
-    logger.info('number of longest transcripts: {}'.format(len(kept_transcripts) - 1))
+    table, lines = read_gtf_table(args.input_file, keep_lines=True, jobs=args.jobs)
+    is_feature = (table['feature'] == feature).values
+    gene_ids = get_gtf_attribute(table, 'gene_id')[is_feature]
+    transcript_ids = get_gtf_attribute(table, 'transcript_id')[is_feature]
+    if np.any(transcript_ids == None):
+        raise ValueError('transcript_id not found in GTF file for {} records'.format(
+            np.sum(transcript_ids == None)))
+    lengths = pd.Series(table['end'].values[is_feature] - table['start'].values[is_feature] + 1)
+    # total length of each transcript
+    transcript_lengths = lengths.groupby([gene_ids, transcript_ids], sort=False).sum()
+    # the first transcript with maximum length in each gene
+    longest = transcript_lengths.groupby(level=0, sort=False).idxmax()
+    kept_transcripts = set(transcript_id for gene_id, transcript_id in longest.values)
+    keep = ~is_feature
+    keep[is_feature] = pd.Series(transcript_ids).isin(kept_transcripts).values
+
+    logger.info('number of genes: {}'.format(longest.shape[0]))
+    logger.info('number of transcripts: {}'.format(transcript_lengths.shape[0]))
+    logger.info('number of longest transcripts: {}'.format(len(kept_transcripts)))
     logger.info('write output gtf file: ' + args.output_file)
     with open_file_or_stdout(args.output_file) as fout:
-        for transcript_id, line in lines:
-            if transcript_id in kept_transcripts:
+        for line, kept in zip(iter_gtf_lines(args.input_file, lines), keep):
+            if kept:
                 fout.write(line)
 
 @command_handler
 def gtf_to_transcript_table(args):
-    from ioutils import open_file_or_stdin, open_file_or_stdout
-    from collections import OrderedDict
+    import numpy as np
+    import pandas as pd
+    from ioutils import open_file_or_stdout
 
     feature = args.feature
     default_transcript_type = args.transcript_type
     default_gene_type = args.gene_type
 
-    fout = open_file_or_stdout(args.output_file)
-    with open_file_or_stdin(args.input_file) as fin:
-        transcripts = OrderedDict()
-        for line in fin:
-            c = line.strip().split('\t')
-            if c[0].startswith('#'):
-                continue
-            if c[2] != feature:
-                continue
-            attrs = {}
-            for a in c[8].split(';')[:-1]:
-                a = a.strip()
-                i = a.find(' ')
-                key = a[:i]
-                val = a[(i + 1):].strip('"')
-                attrs[key] = val
-            if 'transcript_name' not in attrs:
-                attrs['transcript_name'] = attrs['transcript_id']
-            if 'gene_name' not in attrs:
-                attrs['gene_name'] = attrs['gene_id']
-            if default_transcript_type is not None:
-                attrs['transcript_type'] = default_transcript_type
-            else:
-                if 'transcript_type' not in attrs:
-                    attrs['transcript_type'] = 'unknown'
-            if default_gene_type is not None:
-                attrs['gene_type'] = default_gene_type
-            else:
-                if 'gene_type' not in attrs:
-                    attrs['gene_type'] = 'unknown'
-            exon = [c[0], int(c[3]) - 1, int(c[4]), attrs['gene_id'], 0, c[6],
-                attrs['gene_id'], attrs['transcript_id'], 
-                attrs['gene_name'], attrs['transcript_name'],
-                attrs['gene_type'], attrs['transcript_type'], c[1]]
-            transcript = transcripts.get(attrs['transcript_id'])
-            if transcript is None:
-                transcripts[attrs['transcript_id']] = exon
-            else:
-                if c[2] == 'exon':
-                    transcript[1] = min(transcript[1], exon[1])
-                    transcript[2] = max(transcript[2], exon[2])
-        header = ['chrom', 'start', 'end', 'name', 'score', 'strand',
-            'gene_id', 'transcript_id', 
-            'gene_name', 'transcript_name',
-            'gene_type', 'transcript_type', 'source'
-        ]
-        print('\t'.join(header), file=fout)
-        for transcript in transcripts.values():
-            print('\t'.join(str(a) for a in transcript), file=fout)
-    fout.close()
+    table, lines = read_gtf_table(args.input_file, jobs=args.jobs)
+    table = table[(table['feature'] == feature).values]
+    attrs = {}
+    for key in ('gene_id', 'transcript_id', 'gene_name', 'transcript_name', 'gene_type', 'transcript_type'):
+        attrs[key] = get_gtf_attribute(table, key)
+    if np.any(attrs['transcript_id'] == None):
+        raise KeyError('transcript_id')
+    attrs['transcript_name'] = np.where(attrs['transcript_name'] == None, attrs['transcript_id'], attrs['transcript_name'])
+    attrs['gene_name'] = np.where(attrs['gene_name'] == None, attrs['gene_id'], attrs['gene_name'])
+    if default_transcript_type is not None:
+        attrs['transcript_type'][:] = default_transcript_type
+    else:
+        attrs['transcript_type'][attrs['transcript_type'] == None] = 'unknown'
+    if default_gene_type is not None:
+        attrs['gene_type'][:] = default_gene_type
+    else:
+        attrs['gene_type'][attrs['gene_type'] == None] = 'unknown'
+    exons = pd.DataFrame({'chrom': table['seqname'].astype('object').values,
+        'start': table['start'].values - 1, 'end': table['end'].values,
+        'name': attrs['gene_id'], 'score': 0, 'strand': table['strand'].astype('object').values,
+        'gene_id': attrs['gene_id'], 'transcript_id': attrs['transcript_id'],
+        'gene_name': attrs['gene_name'], 'transcript_name': attrs['transcript_name'],
+        'gene_type': attrs['gene_type'], 'transcript_type': attrs['transcript_type'],
+        'source': table['source'].astype('object').values})
+    # attributes are taken from the first record of each transcript
+    grouped = exons.groupby(attrs['transcript_id'], sort=False)
+    transcripts = grouped.first()
+    if feature == 'exon':
+        transcripts['start'] = grouped['start'].min()
+        transcripts['end'] = grouped['end'].max()
+    transcripts = transcripts[exons.columns.values]
+
+    with open_file_or_stdout(args.output_file) as fout:
+        transcripts.to_csv(fout, sep='\t', header=True, index=False)
+
+TRANSCRIPT_TABLE_COLUMNS = ['chrom', 'start', 'end', 'name', 'score', 'strand', 
+    'gene_id', 'transcript_id', 'gene_name', 'transcript_name', 'gene_type', 'transcript_type', 'source']
+
+class GtfBiotypeWriter(object):
+    """Write GTF records of one biotype and build the transcript table and 
+    longest transcripts of the records on the fly
+
+    The transcript table is the same as the output of gtf_to_transcript_table 
+    with --gene-type and --transcript-type set to the biotype.
+    The longest transcript GTF is the same as the output of extract_longest_transcript.
+    If write_gtf is False, gtf_file should already contain the records and is only read
+    to create the longest transcript GTF.
+    """
+    def __init__(self, rna_type, gtf_file, transcript_table_file=None, 
+            longest_transcript_file=None, feature='exon', buffer_size=1048576, write_gtf=True):
+        self.rna_type = rna_type
+        self.gtf_file = gtf_file
+        self.transcript_table_file = transcript_table_file
+        self.longest_transcript_file = longest_transcript_file
+        self.feature = feature
+        self.fout = open(gtf_file, 'w', buffering=buffer_size) if write_gtf else None
+        self.buffer_size = buffer_size
+        self.n_records = 0
+        # transcript_id => transcript table record
+        self.transcripts = {}
+        # gene_id => {transcript_id: length}
+        self.transcript_lengths = {}
+    
+    def write(self, c, attrs, line):
+        if self.fout is not None:
+            self.fout.write(line)
+        self.n_records += 1
+        if c[2] != self.feature:
+            return
+        transcript_id = attrs.get('transcript_id')
+        if transcript_id is None:
+            raise ValueError('transcript_id not found in GTF record: ' + line.strip())
+        gene_id = attrs['gene_id']
+        start = int(c[3]) - 1
+        end = int(c[4])
+        record = self.transcripts.get(transcript_id)
+        if record is None:
+            self.transcripts[transcript_id] = [c[0], start, end, gene_id, 0, c[6], 
+                gene_id, transcript_id, attrs.get('gene_name', gene_id), 
+                attrs.get('transcript_name', transcript_id),
+                self.rna_type, self.rna_type, c[1]]
+        elif self.feature == 'exon':
+            record[1] = min(record[1], start)
+            record[2] = max(record[2], end)
+        lengths = self.transcript_lengths.setdefault(gene_id, {})
+        lengths[transcript_id] = lengths.get(transcript_id, 0) + end - start
+    
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+        logger.info('{}: {} records, {} transcripts, {} genes'.format(self.rna_type, 
+            self.n_records, len(self.transcripts), len(self.transcript_lengths)))
+        if self.transcript_table_file is not None:
+            with open(self.transcript_table_file, 'w', buffering=self.buffer_size) as f:
+                f.write('\t'.join(TRANSCRIPT_TABLE_COLUMNS) + '\n')
+                for record in self.transcripts.values():
+                    f.write('\t'.join(map(str, record)) + '\n')
+        if self.longest_transcript_file is not None:
+            kept_transcripts = set()
+            for lengths in self.transcript_lengths.values():
+                # max returns the first transcript with maximum length
+                kept_transcripts.add(max(lengths, key=lengths.get))
+            # filter the records of this biotype instead of the whole annotation
+            with open(self.gtf_file, 'r') as fin, \
+                open(self.longest_transcript_file, 'w', buffering=self.buffer_size) as fout:
+                for line in fin:
+                    # comment lines are not records (same as extract_longest_transcript)
+                    if line.startswith('#'):
+                        continue
+                    c = line.split('\t', 3)
+                    if c[2] == self.feature:
+                        if parse_gtf_attributes(line.rstrip().split('\t')[8])['transcript_id'] not in kept_transcripts:
+                            continue
+                    fout.write(line)
+
+def get_biotype_selectors(rna_types):
+    """Get functions that select GTF records of each biotype from a GENCODE GTF file
+
+    Returns
+    -------
+    selectors: list of tuple
+        Each element is a tuple (rna_type, selector). selector(attrs, line) returns 
+        True if the record belongs to rna_type.
+        
+    """
+    selectors = []
+    for rna_type in rna_types:
+        if rna_type == 'mRNA':
+            selector = lambda attrs, line: (attrs.get('gene_type') == 'protein_coding') and ('Selenocysteine' not in line)
+        elif rna_type == 'Y_RNA':
+            selector = lambda attrs, line: attrs.get('gene_name') == 'Y_RNA'
+        elif rna_type == 'srpRNA':
+            selector = lambda attrs, line: attrs.get('gene_name', '').startswith('RN7SL')
+        else:
+            selector = (lambda rna_type: lambda attrs, line: attrs.get('gene_type') == rna_type)(rna_type)
+        selectors.append((rna_type, selector))
+    return selectors
+
+@command_handler
+def split_gtf_by_biotype(args):
+    import shutil
+
+    rna_types = []
+    for s in args.rna_types:
+        rna_types += [a for a in s.split(',') if a]
+    copy_gtfs = {}
+    for s in args.copy_gtf:
+        rna_type, filename = s.split('=', 1)
+        copy_gtfs[rna_type] = filename
+    
+    def create_writer(rna_type, write_gtf=True):
+        return GtfBiotypeWriter(rna_type, 
+            os.path.join(args.gtf_dir, rna_type + '.gtf'),
+            transcript_table_file=os.path.join(args.transcript_table_dir, rna_type + '.txt') if args.transcript_table_dir else None,
+            longest_transcript_file=os.path.join(args.longest_transcript_dir, rna_type + '.gtf') if args.longest_transcript_dir else None,
+            feature=args.feature, write_gtf=write_gtf)
+
+    for dirname in (args.gtf_dir, args.transcript_table_dir, args.longest_transcript_dir):
+        if dirname and (not os.path.isdir(dirname)):
+            logger.info('create directory: ' + dirname)
+            os.makedirs(dirname)
+    
+    for rna_type, filename in copy_gtfs.items():
+        if rna_type not in rna_types:
+            continue
+        # copy the file verbatim (same as cp) and parse records only for derived outputs
+        logger.info('copy GTF file for {}: {}'.format(rna_type, filename))
+        with open_gtf_file(filename) as fin, open(os.path.join(args.gtf_dir, rna_type + '.gtf'), 'w') as fout:
+            shutil.copyfileobj(fin, fout, 1048576)
+        if args.transcript_table_dir or args.longest_transcript_dir:
+            writer = create_writer(rna_type, write_gtf=False)
+            for c, attrs, line in read_gtf(filename, jobs=args.jobs):
+                writer.write(c, attrs, line)
+            writer.close()
+
+    rna_types = [rna_type for rna_type in rna_types if rna_type not in copy_gtfs]
+    writers = [(rna_type, selector, create_writer(rna_type)) for rna_type, selector in get_biotype_selectors(rna_types)]
+    logger.info('read GTF file: ' + args.input_file)
+    for c, attrs, line in read_gtf(args.input_file, jobs=args.jobs):
+        for rna_type, selector, writer in writers:
+            if selector(attrs, line):
+                writer.write(c, attrs, line)
+    for rna_type, selector, writer in writers:
+        writer.close()
 
 @command_handler
 def extract_circrna_junction(args):
-    from Bio import SeqIO
-    from ioutils import open_file_or_stdin, open_file_or_stdout
+    from ioutils import open_file_or_stdout, scan_fasta, read_fasta_index, read_fasta_region
 
     anchor_size = args.anchor_size
+    def write_junction(name, length, head, tail):
+        if length < args.min_length:
+            return
+        seq_id = name.split('|')[0]
+        fout.write('>{}\n'.format(seq_id))
+        fout.write((tail + head).decode())
+        fout.write('\n')
+
     logger.info('read sequence file: ' + args.input_file)
     logger.info('create output file: ' + args.output_file)
     fout = open_file_or_stdout(args.output_file)
-    with open_file_or_stdin(args.input_file) as fin:
-        for record in SeqIO.parse(fin, 'fasta'):
-            seq = str(record.seq)
-            if len(seq) < args.min_length:
-                continue
-            s = min(len(seq), anchor_size)
-            seq_id = record.id.split('|')[0]
-            fout.write('>{}\n'.format(seq_id))
-            fout.write(seq[-s:] + seq[:s])
-            fout.write('\n')
+    index_file = args.input_file + '.fai'
+    if (args.input_file != '-') and os.path.exists(index_file) and (os.path.getmtime(index_file) >= os.path.getmtime(args.input_file)):
+        # read anchors using offsets in the FASTA index
+        logger.info('read FASTA index: ' + index_file)
+        with open(args.input_file, 'rb') as fin:
+            for entry in read_fasta_index(index_file):
+                name, length = entry[:2]
+                s = min(length, anchor_size)
+                write_junction(name, length, read_fasta_region(fin, entry, 0, s),
+                    read_fasta_region(fin, entry, length - s, length))
+    else:
+        # keep anchors while scanning the file
+        fin = sys.stdin.buffer if args.input_file == '-' else open(args.input_file, 'rb')
+        with fin:
+            for name, length, offset, line_bases, line_width, head, tail in scan_fasta(fin, keep_ends=anchor_size):
+                write_junction(name, length, head, tail)
     fout.close()
 
 @command_handler
 def filter_circrna_reads(args):
-    import pysam
     import numpy as np
-    from ioutils import open_file_or_stdout, open_file_or_stdin
-    from collections import defaultdict
-    from copy import deepcopy
-
-    logger.info('read input SAM file: ' + args.input_file)
-    fin = open_file_or_stdin(args.input_file)
-    sam_in = pysam.AlignmentFile(fin, "r")
-    if sam_in.header is None:
-        raise ValueError('requires SAM header to get junction positions')
-    # get junction positions (middle of the sequences)
-    junction_positions = {}
-    for sq in sam_in.header['SQ']:
-        junction_positions[sq['SN']] = sq['LN']//2
+    from ioutils import open_file_or_stdout, open_alignment_file
 
-    logger.info('create output SAM file: ' + args.output_file)
-    fout = open_file_or_stdout(args.output_file)
-    sam_out = pysam.AlignmentFile(fout, 'w', template=sam_in)
+    def get_write_mode(filename):
+        output_format = args.output_format
+        if output_format == 'auto':
+            output_format = 'bam' if filename.endswith('.bam') else 'sam'
+        return 'wb' if output_format == 'bam' else 'w'
 
+    logger.info('read input SAM/BAM file: ' + args.input_file)
+    sam_in = open_alignment_file(args.input_file, 'r', threads=args.threads)
+    if len(sam_in.references) == 0:
+        raise ValueError('requires SAM header to get junction positions')
+    # junction positions (middle of the sequences) indexed by reference id
+    junction_positions = np.asarray(sam_in.lengths, dtype=np.int64)//2
+
+    logger.info('create output SAM/BAM file: ' + args.output_file)
+    sam_out = open_alignment_file(args.output_file, get_write_mode(args.output_file), 
+        threads=args.threads, template=sam_in)
     sam_filtered = None
     if args.filtered_file is not None:
-        logger.info('create filtered SAM file: ' + args.filtered_file)
-        sam_filtered = pysam.AlignmentFile(args.filtered_file, 'w', template=sam_in)
+        logger.info('create filtered SAM/BAM file: ' + args.filtered_file)
+        sam_filtered = open_alignment_file(args.filtered_file, get_write_mode(args.filtered_file), 
+            threads=args.threads, template=sam_in)
 
+    # filter reasons: 0 (kept), 1 (unmapped), 2 (reverse strand), 3 (not crossing junction)
+    reasons = ['kept', 'unmapped', 'reverse', 'no_junction']
+    counts = np.zeros(len(reasons), dtype=np.int64)
+    batch_size = args.batch_size
+    def filter_batch(reads):
+        n = len(reads)
+        flag = np.fromiter((read.flag for read in reads), dtype=np.int32, count=n)
+        reference_id = np.fromiter((read.reference_id for read in reads), dtype=np.int64, count=n)
+        reference_start = np.fromiter((read.reference_start for read in reads), dtype=np.int64, count=n)
+        reference_end = np.fromiter((read.reference_end or -1 for read in reads), dtype=np.int64, count=n)
+        unmapped = ((flag & 0x4) != 0) | (reference_id < 0)
+        reverse = ~unmapped & ((flag & 0x10) != 0)
+        pos = junction_positions[np.where(unmapped, 0, reference_id)]
+        no_junction = ~unmapped & ~reverse & ~((reference_start < pos) & (pos <= reference_end))
+        reason = np.zeros(n, dtype=np.int64)
+        reason[unmapped] = 1
+        reason[reverse] = 2
+        reason[no_junction] = 3
+        counts[:] += np.bincount(reason, minlength=len(reasons))
+        for read, r in zip(reads, reason):
+            if r == 0:
+                sam_out.write(read)
+            elif sam_filtered is not None:
+                sam_filtered.write(read)
+    
+    reads = []
     for read in sam_in:
-        filtered = False
-        if read.is_unmapped:
-            filtered = True
-        elif read.is_reverse:
-            filtered = True
-        else:
-            pos = junction_positions[read.reference_name]
-            if not (read.reference_start < pos <= read.reference_end):
-                filterd = True
-        if not filtered:
-            sam_out.write(read)
-        elif sam_filtered is not None:
-            sam_filtered.write(read)
+        reads.append(read)
+        if len(reads) >= batch_size:
+            filter_batch(reads)
+            reads = []
+    if len(reads) > 0:
+        filter_batch(reads)
     
-    fin.close()
-    fout.close()
+    sam_in.close()
+    sam_out.close()
     if sam_filtered is not None:
         sam_filtered.close()
+    
+    n_reads = counts.sum()
+    for reason, count in zip(reasons, counts):
+        logger.info('{}: {} ({:.2f}%)'.format(reason, count, 100.0*count/max(n_reads, 1)))
+    if args.summary_file is not None:
+        logger.info('write summary file: ' + args.summary_file)
+        with open_file_or_stdout(args.summary_file) as f:
+            f.write('reason\tcount\n')
+            f.write('total\t{}\n'.format(n_reads))
+            for reason, count in zip(reasons, counts):
+                f.write('{}\t{}\n'.format(reason, count))
 
 @command_handler
 def chrom_sizes(args):
-    from Bio import SeqIO
-    from ioutils import open_file_or_stdin, open_file_or_stdout
+    from ioutils import open_file_or_stdout, get_fasta_index, scan_fasta
 
-    fout = open_file_or_stdout(args.output_file)
-    with open_file_or_stdin(args.input_file) as fin:
-        for record in SeqIO.parse(fin, 'fasta'):
-            fout.write('{}\t{}\n'.format(record.id, len(record.seq)))
+    if args.input_file == '-':
+        index = [record[:5] for record in scan_fasta(sys.stdin.buffer)]
+    else:
+        index = get_fasta_index(args.input_file)
+    with open_file_or_stdout(args.output_file) as fout:
+        for name, length, offset, line_bases, line_width in index:
+            fout.write('{}\t{}\n'.format(name, length))
         
 if __name__ == '__main__':
     main_parser = argparse.ArgumentParser(description='Preprocessing module')
@@ -319,6 +810,8 @@ if __name__ == '__main__':
         help='input transcript BAM file')
     parser.add_argument('--output-file', '-o', type=str, default='-',
         help='output transcript counts file')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression')
     
     parser = subparsers.add_parser('gtf_to_transcript_table')
     parser.add_argument('--input-file', '-i', type=str, default='-',
@@ -331,6 +824,8 @@ if __name__ == '__main__':
         help='gene type to set if "gene_type" attribute is not available in GTF file')
     parser.add_argument('--transcript-type', type=str, default='unknown',
         help='gene type to set if "transcript_type" attribute is not available in GTF file')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to parse the GTF file in parallel')
     
     parser = subparsers.add_parser('extract_longest_transcript')
     parser.add_argument('--input-file', '-i', type=str, default='-',
@@ -339,6 +834,28 @@ if __name__ == '__main__':
         help='output table file')
     parser.add_argument('--feature', type=str, default='exon',
         help='feature to use in input GTF file (Column 3)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to parse the GTF file in parallel')
+    
+    parser = subparsers.add_parser('split_gtf_by_biotype',
+        help='split a GTF file by biotype and create transcript tables and longest transcripts in one pass')
+    parser.add_argument('--input-file', '-i', type=str, required=True,
+        help='input GTF file (GENCODE)')
+    parser.add_argument('--rna-types', type=str, action='append', required=True,
+        help='comma-separated list of RNA types to extract')
+    parser.add_argument('--copy-gtf', type=str, action='append', default=[],
+        help='use all records in a GTF file for an RNA type instead of selecting records from the input file. '
+        'Format: rna_type=filename')
+    parser.add_argument('--feature', type=str, default='exon',
+        help='feature to use in input GTF file (Column 3)')
+    parser.add_argument('--gtf-dir', type=str, required=True,
+        help='output directory for GTF files ({rna_type}.gtf)')
+    parser.add_argument('--transcript-table-dir', type=str,
+        help='output directory for transcript tables ({rna_type}.txt)')
+    parser.add_argument('--longest-transcript-dir', type=str,
+        help='output directory for GTF files of longest transcripts ({rna_type}.gtf)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to parse the GTF file in parallel')
     
     parser = subparsers.add_parser('fix_gtf',
         help='fix problems in a GTF file by removing invalid transcripts')
@@ -357,6 +874,18 @@ if __name__ == '__main__':
         help='output BED file')
     parser.add_argument('--feature', type=str, default='exon',
         help='feature to use in input GTF file (Column 3)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to parse the GTF file in parallel')
+    
+    parser = subparsers.add_parser('gtf_index',
+        help='parse a GTF file into a columnar index file that is used by other GTF commands')
+    parser.add_argument('--input-file', '-i', type=str, required=True,
+        help='input GTF file')
+    parser.add_argument('--output-file', '-o', type=str,
+        help='output index file (default: input file name with suffix .gtfidx). '
+        'Other commands only use the index in the default path')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of processes to parse the GTF file in parallel')
     
     parser = subparsers.add_parser('extract_circrna_junction',
         help='extract circular RNA junction sequences from spliced sequences')
@@ -372,14 +901,22 @@ if __name__ == '__main__':
     parser = subparsers.add_parser('filter_circrna_reads',
         help='filter out reads not crossing circRNA junctions')
     parser.add_argument('--input-file', '-i', type=str, default='-',
-        help='input SAM file')
+        help='input SAM/BAM file')
     parser.add_argument('--output-file', '-o', type=str, default='-',
-        help='output SAM file')
+        help='output SAM/BAM file')
     parser.add_argument('--filtered-file', '-u', type=str,
-        help='write filtered SAM records to file')
+        help='write filtered SAM/BAM records to file')
+    parser.add_argument('--output-format', type=str, default='auto', choices=('auto', 'sam', 'bam'),
+        help='format of output and filtered files. auto: BAM if the file name ends with .bam, otherwise SAM')
+    parser.add_argument('--summary-file', type=str,
+        help='write number of reads kept and filtered by reason to file')
+    parser.add_argument('--batch-size', type=int, default=100000,
+        help='number of reads to filter at a time')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF compression/decompression')
     
     parser = subparsers.add_parser('chrom_sizes',
-        help='create chrom sizes file from FASTA file')
+        help='create chrom sizes file from FASTA file (use the .fai index if available)')
     parser.add_argument('--input-file', '-i', type=str, default='-',
         help='input FASTA')
     parser.add_argument('--output-file', '-o', type=str, default='-',
@@ -9,88 +9,460 @@ def command_handler(f):
     command_handlers[f.__name__] = f
     return f
 
+class Histogram(object):
+    """Histogram with fixed-size bins starting from 0. Each bin has counts for one or more columns.
+
+    Histograms can be written as a dense table (one row for each bin) or in a sparse format
+    that only contains non-zero bins. The sparse format starts with metadata lines::
+
+        #sparse_histogram
+        #name<TAB>read_length_hist
+        #bin_name<TAB>length
+        #bin_size<TAB>1
+        #n_bins<TAB>10000
+        #columns<TAB>query<TAB>reference
+
+    followed by lines of bin index and counts for each column.
+
+    Parameters
+    ----------
+    name: str
+        Name of the metric
+    bin_name: str
+        Column name of bins in the table format
+    columns: list of str
+        Names of count columns
+    bin_size: int
+        Size of each bin
+    counts: ndarray, shape (n_bins, n_columns)
+        Counts in each bin
+    """
+    def __init__(self, name, bin_name, columns, bin_size, counts):
+        self.name = name
+        self.bin_name = bin_name
+        self.columns = list(columns)
+        self.bin_size = bin_size
+        self.counts = counts
+
+    @property
+    def n_bins(self):
+        return self.counts.shape[0]
+
+    def merge(self, other):
+        """Add counts of another histogram with the same metadata
+        """
+        for attr in ('name', 'bin_name', 'columns', 'bin_size', 'n_bins'):
+            if getattr(self, attr) != getattr(other, attr):
+                raise ValueError('cannot merge histograms with different {}: {} and {}'.format(
+                    attr, getattr(self, attr), getattr(other, attr)))
+        self.counts += other.counts
+        return self
+
+    def write(self, f, format='table'):
+        if format == 'table':
+            self.write_table(f)
+        elif format == 'sparse':
+            self.write_sparse(f)
+        else:
+            raise ValueError('unknown histogram format: {}'.format(format))
+
+    def write_table(self, f):
+        f.write('\t'.join([self.bin_name] + self.columns) + '\n')
+        for i in range(self.n_bins):
+            f.write('\t'.join(str(a) for a in [i*self.bin_size] + self.counts[i].tolist()) + '\n')
+
+    def write_sparse(self, f):
+        import numpy as np
+
+        f.write('#sparse_histogram\n')
+        f.write('#name\t{}\n'.format(self.name))
+        f.write('#bin_name\t{}\n'.format(self.bin_name))
+        f.write('#bin_size\t{}\n'.format(self.bin_size))
+        f.write('#n_bins\t{}\n'.format(self.n_bins))
+        f.write('#columns\t{}\n'.format('\t'.join(self.columns)))
+        for i in np.nonzero(np.any(self.counts != 0, axis=1))[0]:
+            f.write('\t'.join(str(a) for a in [i] + self.counts[i].tolist()) + '\n')
+
+    @classmethod
+    def read_sparse(cls, f):
+        import numpy as np
+
+        metadata = {}
+        bins = []
+        values = []
+        for lineno, line in enumerate(f):
+            c = line.rstrip('\n').split('\t')
+            if lineno == 0:
+                if c[0] != '#sparse_histogram':
+                    raise ValueError('not a sparse histogram file')
+            elif c[0].startswith('#'):
+                metadata[c[0][1:]] = c[1:]
+            else:
+                bins.append(int(c[0]))
+                values.append([int(a) for a in c[1:]])
+        for key in ('name', 'bin_name', 'bin_size', 'n_bins', 'columns'):
+            if key not in metadata:
+                raise ValueError('missing metadata in sparse histogram file: ' + key)
+        columns = metadata['columns']
+        counts = np.zeros((int(metadata['n_bins'][0]), len(columns)), dtype=np.int64)
+        if len(bins) > 0:
+            counts[np.asarray(bins)] = np.asarray(values, dtype=np.int64)
+        return cls(metadata['name'][0], metadata['bin_name'][0], columns,
+            int(metadata['bin_size'][0]), counts)
+
+class ReadLengthHist(object):
+    """Histogram of query lengths and reference lengths of reads
+    """
+    def __init__(self, max_length=10000):
+        import numpy as np
+
+        self.max_length = max_length
+        self.counts_ref = np.zeros(max_length, dtype=np.int64)
+        self.counts_query = np.zeros(max_length, dtype=np.int64)
+
+    def add(self, read):
+        self.counts_query[read.query_length] += 1
+        self.counts_ref[min(read.reference_length, self.max_length - 1)] += 1
+
+    def histogram(self):
+        import numpy as np
+
+        return Histogram('read_length_hist', 'length', ['query', 'reference'], 1,
+            np.column_stack([self.counts_query, self.counts_ref]))
+
+    def write(self, f, format='table'):
+        self.histogram().write(f, format=format)
+
+class ReadDuplicateHist(object):
+    """Histogram of duplicate reads and total reads binned by reference length
+
+    The bin index of each reference is precomputed into an array indexed by reference id.
+    Reference ids and duplicate flags are buffered and accumulated for a batch of reads
+    with np.bincount.
+
+    Parameters
+    ----------
+    reference_lengths: array-like, shape (n_references,)
+        Length of each reference in the BAM header. Negative values for unknown lengths.
+    bin_size: int
+        Bin size for reference lengths
+    max_length: int
+        Upper bound for bins
+    batch_size: int
+        Number of reads to buffer before updating the histogram
+    """
+    def __init__(self, reference_lengths, bin_size=10, max_length=10000, batch_size=1000000):
+        import numpy as np
+        from array import array
+
+        self.bin_size = bin_size
+        self.n = max_length//bin_size
+        reference_lengths = np.asarray(reference_lengths, dtype=np.int64)
+        self.bin_index = np.minimum(reference_lengths//bin_size, self.n)
+        self.bin_index[reference_lengths < 0] = -1
+        self.dup_counts = np.zeros(self.n + 1, dtype=np.int64)
+        self.tot_counts = np.zeros(self.n + 1, dtype=np.int64)
+        self.batch_size = batch_size
+        self.reference_ids = array('i')
+        self.is_duplicate = array('B')
+
+    def add(self, read):
+        self.reference_ids.append(read.reference_id)
+        self.is_duplicate.append(read.is_duplicate)
+        if len(self.reference_ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        import numpy as np
+        from array import array
+
+        if len(self.reference_ids) == 0:
+            return
+        reference_ids = np.frombuffer(self.reference_ids, dtype=np.int32)
+        is_duplicate = np.frombuffer(self.is_duplicate, dtype=np.uint8).astype(bool)
+        # skip reads not placed on a reference
+        mapped = reference_ids >= 0
+        index = self.bin_index[reference_ids[mapped]]
+        if np.any(index < 0):
+            raise KeyError('reference length not found for some reads')
+        self.tot_counts += np.bincount(index, minlength=self.n + 1)
+        self.dup_counts += np.bincount(index[is_duplicate[mapped]], minlength=self.n + 1)
+        self.reference_ids = array('i')
+        self.is_duplicate = array('B')
+
+    def histogram(self):
+        import numpy as np
+
+        self.flush()
+        return Histogram('read_duplicate_hist', 'bin', ['duplicates', 'total'], self.bin_size,
+            np.column_stack([self.dup_counts, self.tot_counts]))
+
+    def write(self, f, format='table'):
+        self.histogram().write(f, format=format)
+
+class FragmentLengthHist(object):
+    """Histogram of fragment lengths of paired-end reads
+
+    Mates are paired by query name. Reads waiting for their mates are kept in a dict.
+    For coordinate-sorted input, a read is evicted once the scan has passed the position
+    of its mate, so memory is bounded by the number of reads within the insert size window.
+    For other sort orders (e.g. sorted by name), mates are expected to be adjacent and 
+    waiting reads are evicted when the query name changes.
+
+    Parameters
+    ----------
+    max_length: int
+        Upper bound for fragment lengths
+    sort_order: str
+        'coordinate' or 'queryname'
+    """
+    def __init__(self, max_length=1000, sort_order='coordinate'):
+        import numpy as np
+
+        self.max_length = max_length
+        self.counts = np.zeros(max_length + 1, dtype=np.int64)
+        self.coordinate_sorted = (sort_order == 'coordinate')
+        # query_name => (reference_start, reference_end)
+        self.pending = {}
+        # heap of (mate reference id, mate position, query_name)
+        self.mate_positions = []
+        self.query_name = None
+        self.n_pairs = 0
+        self.n_evicted = 0
+
+    def evict(self, reference_id, position):
+        import heapq
+
+        mate_positions = self.mate_positions
+        while mate_positions and ((mate_positions[0][0], mate_positions[0][1]) < (reference_id, position)):
+            mate_reference_id, mate_position, query_name = heapq.heappop(mate_positions)
+            # the read may have been paired already
+            if self.pending.pop(query_name, None) is not None:
+                self.n_evicted += 1
+
+    def add(self, read):
+        import heapq
+
+        if (not read.is_paired) or (not read.is_proper_pair):
+            return
+        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+            return
+        if read.reference_id != read.next_reference_id:
+            return
+        if self.coordinate_sorted:
+            self.evict(read.reference_id, read.reference_start)
+        elif read.query_name != self.query_name:
+            self.n_evicted += len(self.pending)
+            self.pending.clear()
+            self.query_name = read.query_name
+        mate = self.pending.pop(read.query_name, None)
+        if mate is None:
+            self.pending[read.query_name] = (read.reference_start, read.reference_end)
+            if self.coordinate_sorted:
+                heapq.heappush(self.mate_positions, 
+                    (read.next_reference_id, read.next_reference_start, read.query_name))
+        else:
+            length = max(mate[1], read.reference_end) - min(mate[0], read.reference_start)
+            self.counts[min(length, self.max_length)] += 1
+            self.n_pairs += 1
+    
+    @property
+    def n_unpaired(self):
+        """Number of reads still waiting for their mates
+        """
+        return len(self.pending)
+
+    def histogram(self):
+        return Histogram('fragment_length_hist', 'fragment_length', ['counts'], 1,
+            self.counts.reshape((-1, 1)))
+
+    def write(self, f, format='table'):
+        self.histogram().write(f, format=format)
+
+class TranscriptCounts(object):
+    """Number of reads mapped to each reference (same output as count_reads.py count_transcript)
+    """
+    def __init__(self, references, min_mapping_quality=0, strandness='no'):
+        from collections import OrderedDict
+
+        self.references = references
+        self.min_mapping_quality = min_mapping_quality
+        self.strandness = {'no': 0, 'forward': 1, 'reverse': 2}.get(strandness, 0)
+        self.counts = OrderedDict()
+
+    def add(self, read):
+        if read.is_unmapped:
+            return
+        if read.mapping_quality < self.min_mapping_quality:
+            return
+        if (self.strandness == 1) and read.is_reverse:
+            return
+        if (self.strandness == 2) and (not read.is_reverse):
+            return
+        if read.reference_name not in self.counts:
+            self.counts[read.reference_name] = 0
+        self.counts[read.reference_name] += 1
+
+    def write(self, f, format='table'):
+        if self.references:
+            for name in self.references:
+                f.write('{}\t{}\n'.format(name, self.counts.get(name, 0)))
+        else:
+            for name, count in self.counts.items():
+                f.write('{}\t{}\n'.format(name, count))
+
+def get_reference_lengths(filename, chrom_sizes_file=None):
+    """Get length of each reference in the header of a BAM/SAM file
+
+    If chrom_sizes_file is given, lengths are taken from the file instead of the header
+    and references not found in the file have length -1.
+    """
+    from ioutils import open_alignment_file
+
+    with open_alignment_file(filename, "rb") as sam:
+        references = sam.references
+        lengths = list(sam.lengths)
+    if chrom_sizes_file is not None:
+        logger.info('read chrom sizes: ' + chrom_sizes_file)
+        chrom_sizes = read_chrom_sizes(chrom_sizes_file)
+        lengths = [chrom_sizes.get(name, -1) for name in references]
+    else:
+        logger.info('use reference lengths in BAM header')
+    return lengths
+
+def read_chrom_sizes(filename):
+    chrom_sizes = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            c = line.strip().split('\t')
+            chrom_sizes[c[0]] = int(c[1])
+    return chrom_sizes
+
+def get_sort_order(filename):
+    """Get sort order (SO) from the header line of a BAM/SAM file
+    """
+    from ioutils import open_alignment_file
+
+    with open_alignment_file(filename, "rb") as sam:
+        return sam.header.to_dict().get('HD', {}).get('SO', 'unknown')
+
+def log_fragment_pairing(profiler):
+    logger.info('number of pairs: {}, evicted reads: {}, unpaired reads: {}'.format(
+        profiler.n_pairs, profiler.n_evicted, profiler.n_unpaired))
+
+def profile_reads(filename, profilers, threads=1):
+    """Feed each read in a BAM/SAM file to all profilers in a single pass
+    """
+    from ioutils import open_alignment_file
+
+    sam = open_alignment_file(filename, "rb", threads=threads)
+    add_funcs = [profiler.add for profiler in profilers]
+    for read in sam:
+        for add in add_funcs:
+            add(read)
+    sam.close()
+
 @command_handler
 def read_length_hist(args):
-    import pysam
-    import numpy as np
     from ioutils import open_file_or_stdout
 
     logger.info('read input BAM/SAM file: ' + args.input_file)
-    sam = pysam.AlignmentFile(args.input_file, "rb")
-    counts_ref = np.zeros(args.max_length, dtype=np.int64)
-    counts_query = np.zeros(args.max_length, dtype=np.int64)
-    max_length = args.max_length
-    for read in sam:
-        counts_query[read.query_length] += 1
-        counts_ref[min(read.reference_length, max_length - 1)] += 1
+    profiler = ReadLengthHist(max_length=args.max_length)
+    profile_reads(args.input_file, [profiler], threads=args.threads)
     
     logger.info('create output file: ' + args.output_file)
     with open_file_or_stdout(args.output_file) as f:
-        f.write('length\tquery\treference\n')
-        for i in range(args.max_length):
-            f.write('{}\t{}\t{}\n'.format(i, counts_query[i], counts_ref[i]))
+        profiler.write(f, format=args.output_format)
 
 @command_handler
 def read_duplicate_hist(args):
-    import pysam
-    import numpy as np
     from ioutils import open_file_or_stdout
 
-    bin_size = args.bin_size
-    max_length = args.max_length
-    n = max_length//bin_size
-    bounds = np.arange(0, (n + 1)*bin_size, bin_size)
-
-    logger.info('read chrom sizes: ' + args.chrom_sizes_file)
-    chrom_sizes = {}
-    with open(args.chrom_sizes_file, 'r') as f:
-        for line in f:
-            c = line.strip().split('\t')
-            chrom_sizes[c[0]] = int(c[1])
+    reference_lengths = get_reference_lengths(args.input_file, args.chrom_sizes_file)
     logger.info('read input BAM/SAM file: ' + args.input_file)
-    sam = pysam.AlignmentFile(args.input_file, "rb")
-    dup_counts = np.zeros(n + 1, dtype=np.int64)
-    tot_counts = np.zeros(n + 1, dtype=np.int64)
-    max_length = args.max_length
-    for read in sam:
-        index = min(chrom_sizes[read.reference_name]//bin_size, n)
-        if read.is_duplicate:
-            dup_counts[index] += 1
-        tot_counts[index] += 1
+    profiler = ReadDuplicateHist(reference_lengths, bin_size=args.bin_size, max_length=args.max_length)
+    profile_reads(args.input_file, [profiler], threads=args.threads)
     
     logger.info('create output file: ' + args.output_file)
     with open_file_or_stdout(args.output_file) as f:
-        f.write('bin\tduplicates\ttotal\n')
-        for i in range(n + 1):
-            f.write('{}\t{}\t{}\n'.format(bounds[i], dup_counts[i], tot_counts[i]))
+        profiler.write(f, format=args.output_format)
 
 @command_handler
 def fragment_length_hist(args):
-    import pysam
-    import numpy as np
     from ioutils import open_file_or_stdout
 
-    logger.info('read input BAM/SAM file: ' + args.input_file)
-    sam = pysam.AlignmentFile(args.input_file, "rb")
-    max_length = args.max_length
-    counts = np.zeros(max_length + 1, dtype=np.int64)
-    read1 = None
-    for read in sam:
-        if (not read.is_paired) or (not read.is_proper_pair):
-            continue
-        if read.is_read1:
-            read1 = read
-        elif read.is_read2:
-            if read.query_name != read1.query_name:
-                continue
-            length = read.reference_end - read1.reference_start
-            counts[min(length, max_length)] += 1
+    sort_order = args.sort_order
+    if sort_order == 'auto':
+        sort_order = get_sort_order(args.input_file)
+    logger.info('read input BAM/SAM file ({} sort order): {}'.format(sort_order, args.input_file))
+    profiler = FragmentLengthHist(max_length=args.max_length, sort_order=sort_order)
+    profile_reads(args.input_file, [profiler], threads=args.threads)
+    log_fragment_pairing(profiler)
     
     with open_file_or_stdout(args.output_file) as f:
-        f.write('fragment_length\tcounts\n')
-        for i in range(max_length + 1):
-            f.write('{}\t{}\n'.format(i, counts[i]))
-        
+        profiler.write(f, format=args.output_format)
+
+@command_handler
+def profile_bam(args):
+    from ioutils import open_file_or_stdout, open_alignment_file
+
+    # list of (name, profiler, output_file)
+    profilers = []
+    if args.read_length_hist is not None:
+        profilers.append(('read_length_hist', 
+            ReadLengthHist(max_length=args.read_max_length),
+            args.read_length_hist))
+    if args.read_duplicate_hist is not None:
+        reference_lengths = get_reference_lengths(args.input_file, args.chrom_sizes_file)
+        profilers.append(('read_duplicate_hist', 
+            ReadDuplicateHist(reference_lengths, 
+                bin_size=args.bin_size, max_length=args.duplicate_max_length),
+            args.read_duplicate_hist))
+    if args.fragment_length_hist is not None:
+        sort_order = args.sort_order
+        if sort_order == 'auto':
+            sort_order = get_sort_order(args.input_file)
+        logger.info('sort order for fragment length: ' + sort_order)
+        profilers.append(('fragment_length_hist', 
+            FragmentLengthHist(max_length=args.fragment_max_length, sort_order=sort_order),
+            args.fragment_length_hist))
+    if args.transcript_counts is not None:
+        with open_alignment_file(args.input_file, "rb") as sam:
+            references = sam.references
+        profilers.append(('transcript_counts', 
+            TranscriptCounts(references, min_mapping_quality=args.min_mapping_quality,
+                strandness=args.strandness),
+            args.transcript_counts))
+    if len(profilers) == 0:
+        raise ValueError('at least one output file should be specified')
+
+    logger.info('read input BAM/SAM file: ' + args.input_file)
+    logger.info('metrics: ' + ', '.join(name for name, profiler, output_file in profilers))
+    profile_reads(args.input_file, [profiler for name, profiler, output_file in profilers],
+        threads=args.threads)
+
+    for name, profiler, output_file in profilers:
+        if name == 'fragment_length_hist':
+            log_fragment_pairing(profiler)
+        logger.info('create output file for {}: {}'.format(name, output_file))
+        with open_file_or_stdout(output_file) as f:
+            profiler.write(f, format=args.hist_format)
+
+@command_handler
+def merge_hist(args):
+    from ioutils import open_file_or_stdin, open_file_or_stdout
+
+    hist = None
+    for input_file in args.input_file:
+        logger.info('read histogram file: ' + input_file)
+        with open_file_or_stdin(input_file) as f:
+            if hist is None:
+                hist = Histogram.read_sparse(f)
+            else:
+                hist.merge(Histogram.read_sparse(f))
+    logger.info('create output file: ' + args.output_file)
+    with open_file_or_stdout(args.output_file) as f:
+        hist.write(f, format=args.output_format)
 
 if __name__ == '__main__':
     main_parser = argparse.ArgumentParser(description='Statistics of exRNA datasets')
@@ -99,15 +471,25 @@ if __name__ == '__main__':
     parser = subparsers.add_parser('read_length_hist', 
         help='calculate a histogram for read length distribution')
     parser.add_argument('--input-file', '-i', type=str, required=True, help='input BAM/SAM file')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression')
     parser.add_argument('--output-file', '-o', type=str, default='-', help='output histogram file')
+    parser.add_argument('--output-format', type=str, default='table',
+        choices=('table', 'sparse'),
+        help='table: one row for each bin. sparse: only non-zero bins with metadata (can be merged by merge_hist)')
     parser.add_argument('--max-length', '-l', type=int, default=10000)
 
     parser = subparsers.add_parser('read_duplicate_hist', 
         help='calculate a histogram for duplicate reads fraction vs read length')
     parser.add_argument('--input-file', '-i', type=str, required=True, help='input BAM/SAM file')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression')
     parser.add_argument('--output-file', '-o', type=str, default='-', help='output histogram file')
-    parser.add_argument('--chrom-sizes-file', type=str, required=True, 
-        help='file containing chromosome sizes')
+    parser.add_argument('--output-format', type=str, default='table',
+        choices=('table', 'sparse'),
+        help='table: one row for each bin. sparse: only non-zero bins with metadata (can be merged by merge_hist)')
+    parser.add_argument('--chrom-sizes-file', type=str,
+        help='file containing chromosome sizes. Use reference lengths in the BAM header if not specified')
     parser.add_argument('--bin-size', type=int, default=10, 
         help='bin size for read length')
     parser.add_argument('--max-length', type=int, default=10000,
@@ -116,9 +498,61 @@ if __name__ == '__main__':
     parser = subparsers.add_parser('fragment_length_hist',
         help='calculate a histogram for fragment length in a paired-end BAM/SAM file')
     parser.add_argument('--input-file', '-i', type=str, required=True, help='input BAM/SAM file')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression')
     parser.add_argument('--output-file', '-o', type=str, default='-', help='output histogram file')
+    parser.add_argument('--output-format', type=str, default='table',
+        choices=('table', 'sparse'),
+        help='table: one row for each bin. sparse: only non-zero bins with metadata (can be merged by merge_hist)')
     parser.add_argument('--max-length', type=int, default=1000,
         help='upper bound for fragment lengths')
+    parser.add_argument('--sort-order', type=str, default='auto',
+        choices=('auto', 'coordinate', 'queryname'),
+        help='sort order of the input file for pairing mates. auto: get from the header (SO tag)')
+
+    parser = subparsers.add_parser('profile_bam',
+        help='calculate multiple metrics of a BAM/SAM file in a single pass')
+    parser.add_argument('--input-file', '-i', type=str, required=True, help='input BAM/SAM file')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of threads for BGZF decompression')
+    parser.add_argument('--read-length-hist', type=str,
+        help='output file for read length histogram (same format as read_length_hist)')
+    parser.add_argument('--read-max-length', type=int, default=10000,
+        help='upper bound for read lengths')
+    parser.add_argument('--read-duplicate-hist', type=str,
+        help='output file for duplicate reads histogram (same format as read_duplicate_hist)')
+    parser.add_argument('--chrom-sizes-file', type=str,
+        help='file containing chromosome sizes for --read-duplicate-hist. Use reference lengths in the BAM header if not specified')
+    parser.add_argument('--bin-size', type=int, default=10, 
+        help='bin size for read length in duplicate reads histogram')
+    parser.add_argument('--duplicate-max-length', type=int, default=10000,
+        help='upper bound for bins in duplicate reads histogram')
+    parser.add_argument('--fragment-length-hist', type=str,
+        help='output file for fragment length histogram (same format as fragment_length_hist)')
+    parser.add_argument('--fragment-max-length', type=int, default=1000,
+        help='upper bound for fragment lengths')
+    parser.add_argument('--sort-order', type=str, default='auto',
+        choices=('auto', 'coordinate', 'queryname'),
+        help='sort order of the input file for pairing mates. auto: get from the header (SO tag)')
+    parser.add_argument('--transcript-counts', type=str,
+        help='output file for read counts of each transcript (same format as count_reads.py count_transcript)')
+    parser.add_argument('--min-mapping-quality', '-q', type=int, default=0,
+        help='only count reads with mapping quality greater than this number in transcript counts')
+    parser.add_argument('--strandness', '-s', type=str, default='no',
+        choices=('forward', 'reverse', 'no'),
+        help='strandness for transcript counts')
+    parser.add_argument('--hist-format', type=str, default='table',
+        choices=('table', 'sparse'),
+        help='output format for histograms. table: one row for each bin. sparse: only non-zero bins with metadata')
+
+    parser = subparsers.add_parser('merge_hist',
+        help='sum histograms in sparse format (e.g. from different lanes or samples)')
+    parser.add_argument('--input-file', '-i', type=str, action='append', required=True,
+        help='input histogram file in sparse format. Can be specified multiple times')
+    parser.add_argument('--output-file', '-o', type=str, default='-', help='output histogram file')
+    parser.add_argument('--output-format', type=str, default='sparse',
+        choices=('table', 'sparse'),
+        help='table: one row for each bin. sparse: only non-zero bins with metadata (can be merged by merge_hist)')
     
     args = main_parser.parse_args()
     if args.command is None:
@@ -17,7 +17,17 @@ def open_file_or_stdin(filename):
     else:
         return open(filename, 'r')
 
-formats = ('table', 'csv', 'json', 'html', 'excel', 'hdf', 'sql', 'pickle')
+formats = ('table', 'csv', 'json', 'html', 'excel', 'hdf', 'sql', 'pickle', 'parquet', 'feather')
+# formats that can be read in chunks of rows
+chunked_input_formats = ('table', 'csv', 'hdf', 'sql', 'parquet', 'feather')
+# formats that can be written in chunks of rows
+chunked_output_formats = ('table', 'csv', 'hdf', 'sql', 'parquet', 'feather')
+# formats that are read from or written to file names instead of text streams
+binary_formats = ('excel', 'hdf', 'sql', 'pickle', 'parquet', 'feather')
+compression_methods = {
+    'parquet': ('snappy', 'gzip', 'brotli', 'lz4', 'zstd', 'none'),
+    'feather': ('lz4', 'zstd', 'none')
+}
 
 def detect_format(filename):
     ext = os.path.splitext(filename)[1]
@@ -33,77 +43,266 @@ def detect_format(filename):
         '.hdf5': 'hdf',
         '.hdf': 'hdf',
         '.sql': 'sql',
+        '.db': 'sql',
+        '.sqlite': 'sql',
         '.pkl': 'pickle',
-        '.pickle': 'pickle'
+        '.pickle': 'pickle',
+        '.parquet': 'parquet',
+        '.feather': 'feather'
     }.get(ext)
     if format is None:
         raise ValueError('unknown file extension: {}'.format(ext))
     return format
-    
+
+def parse_key_values(args, name):
+    '''Parse a list of key=value strings into a dict
+
+    Values are converted to Python literals (e.g. 0, None, False) if possible, otherwise kept as strings.
+    '''
+    import ast
+
+    d = {}
+    if not args:
+        return d
+    for arg in args:
+        c = arg.split('=', 1)
+        if len(c) != 2:
+            raise ValueError('{} args should be specified as key=value'.format(name))
+        try:
+            d[c[0]] = ast.literal_eval(c[1])
+        except (ValueError, SyntaxError):
+            d[c[0]] = c[1]
+    return d
+
+def read_chunks(filename, format, reader_args, chunk_size=None, table_name=None):
+    '''Read a table as an iterator of DataFrames
+
+    If chunk_size is None, the whole table is read as a single DataFrame.
+    For parquet and feather input, each chunk is a record batch.
+    '''
+    if (chunk_size is not None) and (format not in chunked_input_formats):
+        raise ValueError('cannot read {} format in chunks'.format(format))
+    if (format in binary_formats) and (filename == '-'):
+        raise ValueError('cannot read {} format from stdin'.format(format))
+
+    if format == 'sql':
+        import sqlite3
+
+        con = sqlite3.connect(filename)
+        try:
+            sql = reader_args.pop('sql', None)
+            if sql is None:
+                if table_name is None:
+                    raise ValueError('--table-name or a "sql" reader arg is required for sql input')
+                sql = 'SELECT * FROM "{}"'.format(table_name)
+            if chunk_size is None:
+                yield pd.read_sql(sql, con, **reader_args)
+            else:
+                for df in pd.read_sql(sql, con, chunksize=chunk_size, **reader_args):
+                    yield df
+        finally:
+            con.close()
+    elif format == 'parquet':
+        if chunk_size is None:
+            yield pd.read_parquet(filename, **reader_args)
+        else:
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size, **reader_args):
+                yield batch.to_pandas()
+    elif format == 'feather':
+        if chunk_size is None:
+            yield pd.read_feather(filename, **reader_args)
+        else:
+            import pyarrow as pa
+
+            with pa.memory_map(filename, 'r') as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield reader.get_batch(i).to_pandas()
+    elif format == 'hdf':
+        if chunk_size is None:
+            yield pd.read_hdf(filename, **reader_args)
+        else:
+            # chunked reading requires tables written with format='table'
+            with pd.HDFStore(filename, 'r') as store:
+                key = reader_args.pop('key', None)
+                if key is None:
+                    key = store.keys()[0]
+                for df in store.select(key, chunksize=chunk_size, **reader_args):
+                    yield df
+    elif format in binary_formats:
+        yield {'excel': pd.read_excel, 'pickle': pd.read_pickle}[format](filename, **reader_args)
+    else:
+        read_df = {
+            'table': pd.read_table,
+            'csv': pd.read_csv,
+            'json': pd.read_json,
+            'html': pd.read_html
+        }[format]
+        with open_file_or_stdin(filename) as f:
+            if chunk_size is None:
+                yield read_df(f, **reader_args)
+            else:
+                for df in read_df(f, chunksize=chunk_size, **reader_args):
+                    yield df
+
+def to_arrow_table(df, schema=None, index=False):
+    '''Convert a DataFrame to a pyarrow Table and cast it to the schema of the first chunk
+    '''
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=index)
+    if (schema is not None) and (not table.schema.equals(schema, check_metadata=False)):
+        table = table.cast(schema)
+    return table
+
+def write_chunks(chunks, filename, format, writer_args, compression=None, table_name=None, insert_size=10000):
+    '''Write an iterator of DataFrames to a single table
+
+    Returns
+    -------
+    n_rows: int
+        Number of rows written
+    '''
+    if (format in binary_formats) and (filename == '-'):
+        raise ValueError('cannot write {} format to stdout'.format(format))
+    if (compression is not None) and (format in compression_methods) \
+        and (compression not in compression_methods[format]):
+        raise ValueError('compression method {} is not supported by {} format'.format(compression, format))
+    n_rows = 0
+    if format in ('table', 'csv'):
+        if format == 'table':
+            writer_args.setdefault('sep', '\t')
+        header = writer_args.pop('header', True)
+        with open_file_or_stdout(filename) as f:
+            for i, df in enumerate(chunks):
+                df.to_csv(f, header=header if i == 0 else False, **writer_args)
+                n_rows += df.shape[0]
+    elif format == 'sql':
+        import sqlite3
+
+        if table_name is None:
+            raise ValueError('--table-name is required for sql output')
+        if_exists = writer_args.pop('if_exists', 'fail')
+        # rows are inserted by executemany() in batches of insert_size rows
+        writer_args.setdefault('chunksize', insert_size)
+        con = sqlite3.connect(filename)
+        try:
+            for i, df in enumerate(chunks):
+                df.to_sql(table_name, con, if_exists=if_exists if i == 0 else 'append', **writer_args)
+                n_rows += df.shape[0]
+            con.commit()
+        finally:
+            con.close()
+    elif format == 'hdf':
+        key = writer_args.pop('key', table_name if table_name is not None else 'data')
+        # appending to an existing table requires format='table'
+        writer_args.setdefault('format', 'table')
+        for i, df in enumerate(chunks):
+            df.to_hdf(filename, key=key, mode='w' if i == 0 else 'a', append=(i > 0), **writer_args)
+            n_rows += df.shape[0]
+    elif format == 'parquet':
+        import pyarrow.parquet as pq
+
+        index = writer_args.pop('index', False)
+        writer = None
+        try:
+            for df in chunks:
+                if writer is None:
+                    table = to_arrow_table(df, index=index)
+                    writer = pq.ParquetWriter(filename, table.schema,
+                        compression=compression if compression is not None else 'snappy', **writer_args)
+                else:
+                    table = to_arrow_table(df, writer.schema, index=index)
+                writer.write_table(table)
+                n_rows += df.shape[0]
+        finally:
+            if writer is not None:
+                writer.close()
+    elif format == 'feather':
+        import pyarrow as pa
+
+        index = writer_args.pop('index', False)
+        if compression is None:
+            compression = 'lz4'
+        options = pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+        # feather (version 2) files are arrow IPC files
+        writer = None
+        try:
+            for df in chunks:
+                if writer is None:
+                    table = to_arrow_table(df, index=index)
+                    writer = pa.ipc.new_file(filename, table.schema, options=options)
+                else:
+                    table = to_arrow_table(df, writer.schema, index=index)
+                writer.write_table(table)
+                n_rows += df.shape[0]
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        chunks = list(chunks)
+        if len(chunks) != 1:
+            raise ValueError('cannot write {} format in chunks'.format(format))
+        df = chunks[0]
+        if format in binary_formats:
+            {'excel': df.to_excel, 'pickle': df.to_pickle}[format](filename, **writer_args)
+        else:
+            write_df = {
+                'json': df.to_json,
+                'html': df.to_html
+            }[format]
+            with open_file_or_stdout(filename) as f:
+                write_df(f, **writer_args)
+        n_rows = df.shape[0]
+    return n_rows
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Convert table formats')
     parser.add_argument('--input-file', '-i', type=str, default='-')
     parser.add_argument('--output-file', '-o', type=str, default='-')
     parser.add_argument('--sformat', '-s', type=str,
         choices=formats, help='input format')
-    parser.add_argument('--dformat', '-d', type=str, 
+    parser.add_argument('--dformat', '-d', type=str,
         choices=formats, help='output format')
-    parser.add_argument('--reader-args', '-r', type=str, action='append')
-    parser.add_argument('--writer-args', '-w', type=str, action='append')
+    parser.add_argument('--reader-args', '-r', type=str, action='append',
+        help='keyword arguments passed to the pandas reader as key=value. Can be specified multiple times')
+    parser.add_argument('--writer-args', '-w', type=str, action='append',
+        help='keyword arguments passed to the pandas writer as key=value. Can be specified multiple times')
+    parser.add_argument('--chunk-size', '-c', type=int,
+        help='convert the table in chunks of this number of rows instead of loading the whole table. '
+        'Supported input formats: {}. Supported output formats: {}'.format(
+            ', '.join(chunked_input_formats), ', '.join(chunked_output_formats)))
+    parser.add_argument('--compression', type=str,
+        help='compression method for parquet ({}) or feather ({}) output'.format(
+            ', '.join(compression_methods['parquet']), ', '.join(compression_methods['feather'])))
+    parser.add_argument('--table-name', '-t', type=str,
+        help='table name in the SQLite database for sql input/output (or key for hdf output)')
+    parser.add_argument('--insert-size', type=int, default=10000,
+        help='number of rows in each bulk insert for sql output')
     args = parser.parse_args()
 
-    reader_args = {}
-    if args.reader_args:
-        for arg in args.reader_args:
-            c = arg.split('=')
-            if len(c) != 2:
-                raise ValueError('reader args should be specified as key=value')
+    reader_args = parse_key_values(args.reader_args, 'reader')
+    writer_args = parse_key_values(args.writer_args, 'writer')
 
     sformat = detect_format(args.input_file)
     if not sformat:
         sformat = args.sformat
     if not sformat:
         raise ValueError('cannot detect format from input filename and --sformat is not specified')
-    
-    import pandas as pd
-    read_df = {
-        'table': pd.read_table,
-        'csv': pd.read_csv,
-        'json': pd.read_json,
-        'html': pd.read_html,
-        'excel': pd.read_excel,
-        'hdf': pd.read_hdf,
-        'sql': pd.read_sql,
-        'pickle': pd.read_pickle
-    }[sformat]
-    
-    with open_file_or_stdin(args.input_file) as f:
-        df = read_df(f, **reader_args)
 
     dformat = detect_format(args.output_file)
     if not dformat:
         dformat = args.dformat
     if not dformat:
         raise ValueError('cannot detect format from output filename and --dformat is not specified')
-    
-    write_df = {
-        'table': df.to_csv,
-        'csv': df.to_csv,
-        'json': df.to_json,
-        'html': df.to_html,
-        'excel': df.to_excel,
-        'hdf': df.to_hdf,
-        'sql': df.to_sql,
-        'pickle': df.to_pickle
-    }[dformat]
-
-    writer_args = {}
-    if args.writer_args:
-        for arg in args.writer_args:
-            c = arg.split('=')
-            if len(c) != 2:
-                raise ValueError('writer args should be specified as key=value')
-            writer_args[c[0]] = c[1]
-
-    with open_file_or_stdout(args.output_file) as f:
-        write_df(f, **writer_args)
+    if (args.chunk_size is not None) and (dformat not in chunked_output_formats):
+        raise ValueError('cannot write {} format in chunks'.format(dformat))
+
+    chunks = read_chunks(args.input_file, sformat, reader_args,
+        chunk_size=args.chunk_size, table_name=args.table_name)
+    n_rows = write_chunks(chunks, args.output_file, dformat, writer_args,
+        compression=args.compression, table_name=args.table_name, insert_size=args.insert_size)
+    if args.output_file != '-':
+        sys.stderr.write('{} rows written to {}\n'.format(n_rows, args.output_file))